@@ -24,6 +24,7 @@ from commoncore.core import format_color
 def main():
 	kodi.add_menu_item({'mode': 'scraper_list'}, {'title': "Scrapers"}, icon='')
 	kodi.add_menu_item({'mode': 'resource_list'}, {'title': "Installed Scraper Resources"}, icon='')
+	kodi.add_menu_item({'mode': 'scraper_stats'}, {'title': "Scraper Statistics"}, icon='')
 	kodi.add_menu_item({'mode': 'auth_realdebrid'}, {'title': "Authorize RealDebrid"}, icon='settings.png')
 	kodi.add_menu_item({'mode': 'rebuild_settings'}, {'title': "Rebuild Settings File"}, icon='settings.png')
 	kodi.add_menu_item({'mode': 'prune_cache'}, {'title': "Prune Cache"}, icon='settings.png')
@@ -55,6 +56,27 @@ def scraper_list():
 		kodi.add_menu_item({'mode': 'toggle_scraper', "service": s['service']}, {'title': title}, icon='', menu=menu)
 	kodi.eod()
 
+@kodi.register('scraper_stats')
+def scraper_stats():
+	for s in scrapecore.get_scraper_stats():
+		searches = max(s['searches'], 1)
+		failed = s['errors'] + s['timeouts']
+		title = "%s | %s | %s | %s" % (
+			format_color(s['name'], 'orange'),
+			format_color("%.1fs avg" % (s['duration'] / searches), 'blue'),
+			format_color("%.1f results/search" % (float(s['results']) / searches), 'green'),
+			format_color("%s/%s failed" % (failed, s['searches']), 'maroon' if failed else 'green')
+		)
+		kodi.add_menu_item({'mode': 'scraper_quality_stats', "service": s['service']}, {'title': title}, icon='')
+	kodi.eod()
+
+@kodi.register('scraper_quality_stats')
+def scraper_quality_stats():
+	from lib.scrapecore.quality import QUALITY
+	for s in scrapecore.get_scraper_quality_stats(kodi.arg('service')):
+		kodi.add_menu_item({'mode': 'void'}, {'title': "%s: %s" % (QUALITY.r_map[s['quality']], s['results'])}, icon='')
+	kodi.eod()
+
 @kodi.register('uninstall_scraper')
 def uninstall_scraper():
 	if kodi.dialog_confirm("Click YES to proceed", "Uninstall scraper?", kodi.args['name']):
@@ -72,6 +94,24 @@ def rebuild_settings():
 	scrapecore.write_settings_file()
 	kodi.notify('Success', 'Settings File Written')
 
+@kodi.register('prune_cache')
+def prune_cache():
+	from lib.scrapecore import cache
+	from commoncore.core import format_size
+	kodi.open_busy_dialog()
+	try:
+		reclaimed, entries = cache.prune_cache()
+	finally:
+		kodi.close_busy_dialog()
+	kodi.notify('Cache Pruned', 'Reclaimed %s from %s entries' % (format_size(reclaimed), entries))
+
+@kodi.register('benchmark')
+def benchmark():
+	from lib.scrapecore import benchmark
+	results = benchmark.run()
+	failed = [name for name, passed in results.iteritems() if not passed]
+	kodi.notify('Benchmarks Complete', 'Failed: %s' % ', '.join(failed) if failed else 'All passed, see log for timings')
+
 @kodi.register('auth_realdebrid')
 def auth_realdebrid():
 	from commoncore import realdebrid
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import time
+import random
+from commoncore import kodi
+
+"""
+	Benchmarks
+	Each benchmark times a function on synthetic data, logs the results and returns whether it passed.
+	is_linear checks that the time per item at the largest size stays within LINEAR_TOLERANCE times the time per item at the smallest.
+	compare checks that a new implementation is faster than the one it replaces on the same input.
+	Run them from the addon with mode=benchmark, the results are written to the kodi log.
+	They are manual checks on a real install, nothing runs them automatically.
+"""
+
+LINEAR_TOLERANCE = 3.0
+RESULT_SIZES = [1000, 10000, 100000]
+HOSTS = ['openload.co', 'streamango.com', 'rapidgator.net', 'uptobox.com', 'nitroflare.com', 'torrent']
+RELEASES = ['Some.Movie.2017.1080p.BluRay.x264-GRP.mkv', 'Some.Movie.2017.720p.WEB-DL.HEVC.mp4', 'Some Movie 2017 HC HDRip XviD.avi',
+	'Some.Movie.2017.480p.DVDRip.mpg', 'Some.Movie.2017.CAM.flv', 'Some.Movie.2017.2160p.WEB.H265-GRP']
+
+def synthetic_results(n, duplicates=0.2):
+	results = []
+	unique = max(int(n * (1 - duplicates)), 1)
+	for i in xrange(n):
+		index = random.randrange(unique)
+		results.append({
+			"title": random.choice(RELEASES).replace('Some.Movie', 'Movie.%s' % random.randrange(1000)),
+			"raw_url": "http://%s/file/%s" % (random.choice(HOSTS), index),
+			"service": "bench",
+			"host": random.choice(HOSTS),
+			"size": random.choice([0, random.randrange(100000000, 8000000000)]),
+			"quality": random.randrange(1, 10)
+		})
+	return results
+
+def measure(func, make_input, sizes):
+	timings = []
+	for n in sizes:
+		data = make_input(n)
+		start = time.time()
+		func(data)
+		timings.append((n, time.time() - start))
+	return timings
+
+def is_linear(timings):
+	first_n, first_t = timings[0]
+	last_n, last_t = timings[-1]
+	if first_t <= 0: return True
+	return (last_t / last_n) <= (first_t / first_n) * LINEAR_TOLERANCE
+
+def report(name, timings):
+	for n, t in timings:
+		kodi.log("Benchmark %s: n=%s %.4fs (%.2fus per item)" % (name, n, t, t * 1000000 / n))
+	linear = is_linear(timings)
+	kodi.log("Benchmark %s: %s" % (name, 'linear' if linear else 'NOT linear'))
+	return linear
+
+def benchmark_format_results(sizes=RESULT_SIZES):
+	from scrapers import ScrapeCore
+	sc = ScrapeCore([])
+	return report('format_results', measure(sc.prepare_results, synthetic_results, sizes))
+
+def compare(name, old, new, data):
+	start = time.time()
+	old(data)
+	old_time = time.time() - start
+	start = time.time()
+	new(data)
+	new_time = time.time() - start
+	kodi.log("Benchmark %s: old %.4fs new %.4fs (%.1fx)" % (name, old_time, new_time, old_time / max(new_time, 0.000001)))
+	return new_time < old_time
+
+CLASSIFIER_SIZE = 50000
+def benchmark_classifier(size=CLASSIFIER_SIZE):
+	from scrapers.common import BaseScraper, ReleaseClassifier
+	regex = BaseScraper.regex
+	def per_field(strings):
+		# The per field regex calls used by make_media_object before the single pass classifier
+		for string in strings:
+			for k in ['hd1080', 'hd720', 'sd', 'low']:
+				if regex[k].search(string): break
+			for k in ['mkv', 'mp4', 'avi', 'mpg', 'flv']:
+				if regex[k].search(string): break
+			regex['hvec'].search(string)
+			regex['hc'].search(string)
+	def single_pass(strings):
+		classifier = ReleaseClassifier()
+		for string in strings:
+			classifier.classify(string)
+	strings = [r['title'] for r in synthetic_results(size)]
+	return compare('classifier', per_field, single_pass, strings)
+
+PAGE_ITEMS = 400
+def synthetic_page(items=PAGE_ITEMS):
+	# A listing page of roughly 200KB laid out like the sites the scrapers read: nested divs, links, images and scripts
+	head = u'<html><head><title>Listing</title><script type="text/javascript">var x = "<div>";</script></head><body><div id="wrapper"><div class="nav"><a href="/">Home</a> <a href="/movies/">Movies</a></div><div class="list">'
+	rows = []
+	for i in xrange(items):
+		title = random.choice(RELEASES).replace('Some.Movie', 'Movie.%s' % i)
+		rows.append(u'<div class="item" data-id="%s"><div class="poster"><a href="/watch/%s"><img src="/img/%s.jpg" alt="%s" /></a></div>'
+			u'<div class="title"><a href="/watch/%s" title="%s">%s</a></div><div class="meta"><span class="year">2017</span> <span class="quality">%s</span></div>'
+			u'<p class="desc">%s</p></div>\n' % (i, i, i, title, i, title, title, random.choice(['HD', 'CAM', 'SD']), 'Lorem ipsum dolor sit amet. ' * 8))
+	return head + u''.join(rows) + u'</div><div class="footer">&copy;</div></div></body></html>'
+
+PAGE_QUERIES = [('div', {'class': 'item'}, False), ('a', {}, 'href'), ('div', {'class': 'title'}, False), ('img', {}, 'src'), ('span', {'class': 'quality'}, False)]
+def benchmark_parse_dom(items=PAGE_ITEMS):
+	from commoncore import dom_parser
+	import dom
+	page = synthetic_page(items)
+	def run(parse_dom):
+		def queries(html):
+			for name, attrs, ret in PAGE_QUERIES:
+				parse_dom(html, name, attrs, ret)
+		return queries
+	return compare('parse_dom', run(dom_parser.parse_dom), run(dom.parse_dom), page)
+
+def benchmark_loader():
+	# Cold start executes every scraper module as before the manifest, warm start builds LazyScrapers from the manifest
+	import scrapers
+	import scrapecore
+	from loader import ScraperLoader
+	resources = scrapecore.get_installed_resources()
+	def cold(resources):
+		loader = ScraperLoader(vars(scrapers))
+		loader.manifest = {}
+		loader.load(resources, scrapers.ScrapeCoreException)
+	def warm(resources):
+		ScraperLoader(vars(scrapers)).load(resources, scrapers.ScrapeCoreException)
+	return compare('scraper_loader', cold, warm, resources)
+
+BENCHMARKS = [benchmark_format_results, benchmark_classifier, benchmark_parse_dom, benchmark_loader]
+
+def run():
+	return dict([(b.__name__, b()) for b in BENCHMARKS])
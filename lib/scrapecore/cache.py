@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import cPickle
+import hashlib
+import sqlite3
+import threading
+import xbmc
+from collections import OrderedDict
+from urllib import urlencode
+from urlparse import urlsplit, urlunsplit, parse_qsl
+from commoncore import kodi
+
+"""
+	The response cache store
+	Every cached response is a single row in an indexed sqlite table:
+		cache_key		sha1 of the canonical request
+		url				the requested url, for reference only
+		content_type	the response Content-Type header
+		body			the zlib compressed response body
+		size			the length of the compressed body
+		created			unix time the row was written
+		accessed		unix time the row was last served, to within ACCESS_RESOLUTION seconds, used for lru pruning
+		expires			unix time after which the row is stale
+		etag			the response ETag header, sent back as If-None-Match when revalidating
+		last_modified	the response Last-Modified header, sent back as If-Modified-Since
+
+	Parsed forms of a response are kept in the parsed table, one row per return_type, as a zlib compressed pickle.
+	Each row records the created time of the raw row it was parsed from and is only served while that raw row
+	is current and fresh, so replacing, expiring or deleting the raw response invalidates its parsed forms.
+	A revalidated (304) response keeps its created time, so its parsed forms stay valid.
+
+	A cache hit is a single primary key lookup, it only writes when accessed is more than ACCESS_RESOLUTION seconds old,
+	so repeated hits on a row stay read only. get(stale=True) also returns rows that expired less than
+	STALE_GRACE seconds ago, so they can be served while they are revalidated. Rows past the grace period
+	are reclaimed in bulk by purge_expired, using the index on expires, when the store is first opened in a process,
+	and incrementally by CachePruner.
+
+	Each thread gets its own connection, sqlite connections can not be shared between threads.
+"""
+
+ADDON_ID = 'script.module.scrapecore'
+CACHE_PATH = kodi.vfs.join("special://home", "userdata/addon_data/script.module.scrapecore/cache")
+if not kodi.vfs.exists(CACHE_PATH): kodi.vfs.mkdir(CACHE_PATH)
+CACHE_FILE = kodi.vfs.join(CACHE_PATH, 'responses.db')
+SCHEMA_VERSION = 4
+STALE_GRACE = 24 * 3600
+ACCESS_RESOLUTION = 600
+# Files written by the file per response cache: md5 of the url, and the same name with .ts for the cache limit
+LEGACY_FILE = re.compile(r'^[0-9a-f]{32}(\.ts)?$')
+SCHEMA = [
+	'DROP TABLE IF EXISTS responses',
+	'DROP TABLE IF EXISTS parsed',
+	'''CREATE TABLE responses (
+		cache_key TEXT PRIMARY KEY,
+		url TEXT,
+		content_type TEXT,
+		body BLOB,
+		size INTEGER DEFAULT 0,
+		created REAL,
+		accessed REAL,
+		expires REAL,
+		etag TEXT,
+		last_modified TEXT
+	)''',
+	'CREATE INDEX responses_expires ON responses(expires)',
+	'CREATE INDEX responses_accessed ON responses(accessed)',
+	'''CREATE TABLE parsed (
+		cache_key TEXT,
+		return_type TEXT,
+		created REAL,
+		size INTEGER DEFAULT 0,
+		body BLOB,
+		PRIMARY KEY(cache_key, return_type)
+	)'''
+]
+# Return types whose parsed form loads faster than it parses. Unpickling an ElementTree is no faster than
+# parsing the xml again, and soup and dom trees can not be pickled reliably
+PARSED_TYPES = ['json']
+
+def canonical_url(url):
+	if type(url) == unicode:
+		url = url.encode('utf-8')
+	scheme, netloc, path, query, fragment = urlsplit(url)
+	query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+	return urlunsplit((scheme.lower(), netloc.lower(), path or '/', query, ''))
+
+def canonical_key(url, params=None, method=None):
+	if method is None:
+		method = 'POST' if params else 'GET'
+	key = [method.upper(), canonical_url(url)]
+	if params:
+		key.append(json.dumps(params, sort_keys=True))
+	return hashlib.sha1('\n'.join(key)).hexdigest()
+
+class ResponseCache(object):
+	def __init__(self, cache_file=CACHE_FILE):
+		self.cache_file = xbmc.translatePath(cache_file)
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._initialized = False
+
+	def connect(self):
+		if getattr(self._local, 'db', None) is None:
+			db = sqlite3.connect(self.cache_file, timeout=10)
+			db.text_factory = str
+			db.execute('PRAGMA journal_mode=WAL')
+			db.execute('PRAGMA synchronous=NORMAL')
+			self._local.db = db
+			with self._lock:
+				if not self._initialized:
+					self._initialize(db)
+					self._initialized = True
+		return self._local.db
+
+	def _initialize(self, db):
+		version = db.execute('PRAGMA user_version').fetchone()[0]
+		if version != SCHEMA_VERSION:
+			db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+			for sql in SCHEMA:
+				db.execute(sql)
+			db.execute('PRAGMA user_version=%s' % SCHEMA_VERSION)
+			db.commit()
+			db.execute('VACUUM')
+		self._purge_expired(db)
+
+	def get(self, cache_key, stale=False):
+		db = self.connect()
+		now = time.time()
+		oldest = now - STALE_GRACE if stale else now
+		row = db.execute('SELECT body, content_type, expires, etag, last_modified, accessed FROM responses WHERE cache_key=? AND expires>?', [cache_key, oldest]).fetchone()
+		if row is None: return None
+		body, content_type, expires, etag, last_modified, accessed = row
+		if now - accessed > ACCESS_RESOLUTION:
+			db.execute('UPDATE responses SET accessed=? WHERE cache_key=?', [now, cache_key])
+			db.commit()
+		return zlib.decompress(body).decode('utf-8'), content_type, expires, (etag, last_modified)
+
+	def set(self, cache_key, url, body, cache_limit, content_type=None, etag=None, last_modified=None):
+		if type(body) == unicode:
+			body = body.encode('utf-8')
+		body = zlib.compress(body)
+		now = time.time()
+		db = self.connect()
+		expires = now + cache_limit * 3600
+		db.execute('REPLACE INTO responses(cache_key, url, content_type, body, size, created, accessed, expires, etag, last_modified) VALUES(?,?,?,?,?,?,?,?,?,?)', [cache_key, url, content_type, sqlite3.Binary(body), len(body), now, now, expires, etag, last_modified])
+		db.execute('DELETE FROM parsed WHERE cache_key=?', [cache_key])
+		db.commit()
+		return expires
+
+	def get_parsed(self, cache_key, return_type):
+		db = self.connect()
+		row = db.execute('SELECT p.body, r.expires FROM parsed p JOIN responses r ON r.cache_key=p.cache_key AND r.created=p.created WHERE p.cache_key=? AND p.return_type=? AND r.expires>?', [cache_key, return_type, time.time()]).fetchone()
+		if row is None: return None
+		return str(row[0]), row[1]
+
+	def set_parsed(self, cache_key, return_type, data):
+		db = self.connect()
+		db.execute('REPLACE INTO parsed(cache_key, return_type, created, size, body) SELECT cache_key, ?, created, ?, ? FROM responses WHERE cache_key=?', [return_type, len(data), sqlite3.Binary(data), cache_key])
+		db.commit()
+
+	""" Renews a row that revalidated as not modified, returning its new expiry """
+	def touch(self, cache_key, cache_limit):
+		now = time.time()
+		db = self.connect()
+		expires = now + cache_limit * 3600
+		db.execute('UPDATE responses SET accessed=?, expires=? WHERE cache_key=?', [now, expires, cache_key])
+		db.commit()
+		return expires
+
+	def delete(self, cache_key):
+		db = self.connect()
+		db.execute('DELETE FROM responses WHERE cache_key=?', [cache_key])
+		db.execute('DELETE FROM parsed WHERE cache_key=?', [cache_key])
+		db.commit()
+
+	def _purge_expired(self, db):
+		count = db.execute('DELETE FROM responses WHERE expires<=?', [time.time() - STALE_GRACE]).rowcount
+		db.execute('DELETE FROM parsed WHERE cache_key NOT IN (SELECT cache_key FROM responses)')
+		db.commit()
+		return count
+
+	def purge_expired(self):
+		return self._purge_expired(self.connect())
+
+	def clear(self):
+		db = self.connect()
+		db.execute('DELETE FROM responses')
+		db.execute('DELETE FROM parsed')
+		db.commit()
+
+	def total_size(self):
+		return self.connect().execute('SELECT (SELECT IFNULL(SUM(size), 0) FROM responses) + (SELECT IFNULL(SUM(size), 0) FROM parsed)').fetchone()[0]
+
+	def _delete_rows(self, db, rows):
+		keys = [[r[0]] for r in rows]
+		size = sum([r[1] for r in rows])
+		for key in keys:
+			size += db.execute('SELECT IFNULL(SUM(size), 0) FROM parsed WHERE cache_key=?', key).fetchone()[0]
+		db.executemany('DELETE FROM responses WHERE cache_key=?', keys)
+		db.executemany('DELETE FROM parsed WHERE cache_key=?', keys)
+		db.commit()
+		return size
+
+	def delete_expired(self, limit):
+		db = self.connect()
+		rows = db.execute('SELECT cache_key, size FROM responses WHERE expires<=? ORDER BY expires ASC LIMIT ?', [time.time() - STALE_GRACE, limit]).fetchall()
+		return len(rows), self._delete_rows(db, rows)
+
+	def delete_least_recent(self, limit):
+		db = self.connect()
+		rows = db.execute('SELECT cache_key, size FROM responses ORDER BY accessed ASC LIMIT ?', [limit]).fetchall()
+		return len(rows), self._delete_rows(db, rows)
+
+	def vacuum(self, pages):
+		db = self.connect()
+		db.execute('PRAGMA incremental_vacuum(%s)' % int(pages)).fetchall()
+		db.commit()
+
+"""
+	The in-memory tier
+	A thread safe cache of decoded responses held in front of the sqlite store, capped by size in bytes.
+	Eviction policy is either lru (a hit refreshes the entry) or fifo (entries leave in insertion order).
+	hits, misses and evictions are counted so the size can be tuned on low memory devices.
+"""
+
+class MemoryCache(object):
+	def __init__(self, max_bytes, policy='lru'):
+		self.max_bytes = max_bytes
+		self.policy = policy.lower()
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			value, size, expires = entry
+			if expires <= time.time():
+				del self._data[key]
+				self.size -= size
+				self.misses += 1
+				return None
+			if self.policy == 'lru':
+				del self._data[key]
+				self._data[key] = entry
+			self.hits += 1
+			return value
+
+	def set(self, key, value, expires, size=None):
+		if size is None: size = sys.getsizeof(value)
+		if size > self.max_bytes: return
+		with self._lock:
+			if key in self._data:
+				self.size -= self._data.pop(key)[1]
+			self._data[key] = (value, size, expires)
+			self.size += size
+			while self.size > self.max_bytes:
+				self.size -= self._data.popitem(last=False)[1][1]
+				self.evictions += 1
+
+	def delete(self, key):
+		with self._lock:
+			if key in self._data:
+				self.size -= self._data.pop(key)[1]
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.size = 0
+
+	def stats(self):
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._data), "bytes": self.size, "max_bytes": self.max_bytes, "policy": self.policy}
+
+def parsed_cache_enabled():
+	return kodi.get_setting('cache_parsed', ADDON_ID) != 'false'
+
+def parsed_key(cache_key, return_type):
+	return '%s.%s' % (cache_key, return_type)
+
+def dump_parsed(obj):
+	return zlib.compress(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+def load_parsed(data):
+	return cPickle.loads(zlib.decompress(data))
+
+def get_memory_cache_size():
+	try:
+		return int(kodi.get_setting('memory_cache_size', ADDON_ID)) * 1024 * 1024
+	except:
+		return 16 * 1024 * 1024
+
+"""
+	The cache pruner
+	Reclaims disk space in bounded time slices so it can run alongside a search.
+	Each call to run_slice does at most slice_time seconds of work, deleting batch_size rows at a time:
+		1. legacy md5 / .ts file pairs left in CACHE_PATH by the old file cache are removed
+		2. expired rows are removed, oldest expiry first
+		3. while the store is larger than budget bytes, the least recently used rows are removed
+	bytes and entries hold the totals reclaimed so far.
+"""
+
+class CachePruner(object):
+	PHASES = ['legacy', 'expired', 'budget', 'vacuum']
+	def __init__(self, cache, budget, slice_time=0.05, batch_size=50):
+		self.cache = cache
+		self.budget = budget
+		self.slice_time = slice_time
+		self.batch_size = batch_size
+		self.bytes = 0
+		self.entries = 0
+		self.phase = 0
+		self._legacy = None
+
+	@property
+	def finished(self):
+		return self.phase >= len(self.PHASES)
+
+	def _prune_legacy(self):
+		if self._legacy is None:
+			path = xbmc.translatePath(CACHE_PATH)
+			self._legacy = [os.path.join(path, f) for f in os.listdir(path) if LEGACY_FILE.match(f)]
+		batch, self._legacy = self._legacy[0:self.batch_size], self._legacy[self.batch_size:]
+		for f in batch:
+			try:
+				size = os.path.getsize(f)
+				os.remove(f)
+			except OSError: continue
+			self.bytes += size
+			if not f.endswith('.ts'): self.entries += 1
+		return len(self._legacy) > 0
+
+	def _prune_expired(self):
+		count, size = self.cache.delete_expired(self.batch_size)
+		self.entries += count
+		self.bytes += size
+		return count == self.batch_size
+
+	def _prune_budget(self):
+		if self.cache.total_size() <= self.budget: return False
+		count, size = self.cache.delete_least_recent(self.batch_size)
+		self.entries += count
+		self.bytes += size
+		return count > 0
+
+	def _prune_vacuum(self):
+		self.cache.vacuum(self.batch_size * 10)
+		return False
+
+	def run_slice(self):
+		stop = time.time() + self.slice_time
+		while not self.finished and time.time() < stop:
+			if not getattr(self, '_prune_' + self.PHASES[self.phase])():
+				self.phase += 1
+		return not self.finished
+
+	def run(self, pause=0, abort_event=None):
+		while self.run_slice():
+			if abort_event is not None and abort_event.is_set(): break
+			if pause: time.sleep(pause)
+		return self.bytes, self.entries
+
+def get_cache_budget():
+	try:
+		return int(kodi.get_setting('cache_budget', ADDON_ID)) * 1024 * 1024
+	except:
+		return 100 * 1024 * 1024
+
+def prune_cache(pause=0):
+	pruner = CachePruner(response_cache, get_cache_budget())
+	return pruner.run(pause)
+
+""" Background pruning runs at most once every PRUNE_INTERVAL seconds per kodi session, pausing between slices """
+PRUNE_INTERVAL = 3600
+def start_background_prune():
+	if kodi.get_setting('cache_auto_prune', ADDON_ID) == 'false': return
+	try: last_prune = float(kodi.get_property('cache_pruned', ADDON_ID))
+	except: last_prune = 0
+	if last_prune > time.time() - PRUNE_INTERVAL: return
+	kodi.set_property('cache_pruned', str(time.time()), ADDON_ID)
+	t = threading.Thread(target=prune_cache, args=(0.25,))
+	t.daemon = True
+	t.start()
+
+response_cache = ResponseCache()
+memory_cache = MemoryCache(get_memory_cache_size(), kodi.get_setting('memory_cache_policy', ADDON_ID) or 'lru')
+
+def get_cache_stats():
+	return memory_cache.stats()
+
+"""
+	Search results
+	Whole searches are stored in the response store under a scrapecore://search key built from the query and
+	the active scrapers, as json {"created": time, "refreshed": time, "results": [...]}.
+	created is the time of the full search, refreshed the time of the last background refresh.
+	Results refreshed less than result_cache_soft_ttl minutes ago are served as they are. Older ones are served and
+	refreshed in the background. A refresh keeps created and the row's expiry, so result_cache_hard_ttl hours after
+	the full search the row expires and the next search runs in full, however often the query is opened meanwhile.
+	Off by default: until then a cached link that has since died is still offered.
+"""
+RESULTS_URL = 'scrapecore://search'
+
+def result_cache_enabled():
+	return kodi.get_setting('result_cache_enable', ADDON_ID) == 'true'
+
+def get_result_ttls():
+	try: soft = int(kodi.get_setting('result_cache_soft_ttl', ADDON_ID)) * 60
+	except: soft = 3600
+	try: hard = int(kodi.get_setting('result_cache_hard_ttl', ADDON_ID))
+	except: hard = 24
+	return soft, hard
+
+def search_key(query):
+	return canonical_key(RESULTS_URL, query)
+
+""" (created, refreshed, results) of a search stored less than result_cache_hard_ttl hours ago, or None """
+def get_search_results(cache_key):
+	cached = response_cache.get(cache_key)
+	if cached is None: return None
+	try:
+		cached = json.loads(cached[0])
+		created = cached['created']
+		if created + get_result_ttls()[1] * 3600 <= time.time(): return None
+		return created, cached.get('refreshed', created), cached['results']
+	except:
+		return None
+
+""" Stores the results of a full search, or of a refresh of the search created at created, expiring with it """
+def set_search_results(cache_key, results, created=None):
+	now = time.time()
+	if created is None: created = now
+	remaining = created + get_result_ttls()[1] * 3600 - now
+	if remaining <= 0: return
+	body = json.dumps({"created": created, "refreshed": now, "results": results})
+	response_cache.set(cache_key, RESULTS_URL, body, remaining / 3600.0, 'application/json')
@@ -32,4 +32,4 @@ class DBI(SQLiteDatabase):
 			self.commit()
 		self.disconnect()
 
-DB = DBI(DB_FILE, quiet=True, connect=True, version=1)
+DB = DBI(DB_FILE, quiet=True, connect=True, version=3)
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+from __future__ import absolute_import
+import json
+import time
+import threading
+from scrapecore import scrapecore
+from commoncore import kodi
+
+"""
+	Debrid helpers shared by the premium and torrent scrapers
+
+	Instant availability is normalised to {provider: {hash: True|False}} with lower case hashes,
+	whichever provider answered.
+	Answers are kept in the hash_cache table of core.db. Positive answers live for hash_cache_positive_ttl hours,
+	negative answers for hash_cache_negative_ttl minutes, as an uncached torrent may be cached at any time.
+	Only unknown or expired hashes are sent upstream.
+"""
+
+ADDON_ID = 'script.module.scrapecore'
+DATA_PATH = "special://home/userdata/addon_data/script.module.scrapecore"
+HOSTS_FILE = kodi.vfs.join(DATA_PATH, 'hosts.json')
+HOSTS_TTL = 6 * 3600
+# After an empty or failed host list fetch, callers get the empty list for HOSTS_RETRY seconds before fetching again
+HOSTS_RETRY = 60
+HOSTS_WAIT = 30
+RACE_GRACE = 2
+TRANSFER_DEADLINE = 30
+TRANSFER_FIRST_POLL = 0.15
+TRANSFER_MAX_POLL = 5
+TRANSFER_FAILED = ['error', 'deleted', 'banned', 'timeout']
+PROVIDERS = ['realdebrid', 'premiumize']
+# The maximum number of hashes sent in one availability request
+BATCH_SIZES = {'realdebrid': 100, 'premiumize': 100}
+# How long the first torrent scraper of a search waits for the others to submit their hashes
+HASH_BATCH_WINDOW = 0.5
+HASH_CHECK_TIMEOUT = 20
+POSITIVE_TTL = 24 * 3600
+NEGATIVE_TTL = 30 * 60
+
+def get_provider(provider):
+	if provider == 'realdebrid':
+		from commoncore import realdebrid
+		return realdebrid
+	else:
+		from commoncore import premiumize
+		return premiumize
+
+def enabled_providers():
+	return [p for p in PROVIDERS if kodi.get_setting('%s_enable' % p, ADDON_ID) == 'true']
+
+def get_hash_ttls():
+	try: positive = int(kodi.get_setting('hash_cache_positive_ttl', ADDON_ID)) * 3600
+	except: positive = POSITIVE_TTL
+	try: negative = int(kodi.get_setting('hash_cache_negative_ttl', ADDON_ID)) * 60
+	except: negative = NEGATIVE_TTL
+	return positive, negative
+
+def chunks(items, size):
+	return [items[i:i+size] for i in xrange(0, len(items), size)]
+
+def parse_availability(provider, response, hashes):
+	available = {}
+	for hash in hashes:
+		try:
+			if provider == 'realdebrid':
+				entry = response.get(hash, response.get(hash.upper()))
+				available[hash] = entry['rd'] != []
+			else:
+				available[hash] = response['hashes'][hash]['status'] == 'finished'
+		except:
+			available[hash] = False
+	return available
+
+def fetch_availability(provider, hashes):
+	try:
+		response = get_provider(provider).check_hashes(hashes)
+	except Exception, e:
+		kodi.log(e)
+		return None
+	return parse_availability(provider, response or {}, hashes)
+
+def normalize_hashes(hashes):
+	return list(set([h.lower() for h in hashes if h]))
+
+""" Checks every enabled provider at once, each batch of unknown hashes in its own thread """
+def check_hashes(hashes, providers=None):
+	hashes = normalize_hashes(hashes)
+	if providers is None: providers = enabled_providers()
+	results = dict([(p, {}) for p in PROVIDERS])
+	fetched = dict([(p, {}) for p in PROVIDERS])
+	lock = threading.Lock()
+	def fetch(provider, batch):
+		available = fetch_availability(provider, batch)
+		if available is None: return
+		with lock:
+			fetched[provider].update(available)
+	threads = []
+	for provider in providers:
+		results[provider] = scrapecore.get_cached_hashes(provider, hashes)
+		unknown = [h for h in hashes if h not in results[provider]]
+		for batch in chunks(unknown, BATCH_SIZES[provider]):
+			t = threading.Thread(target=fetch, args=(provider, batch))
+			t.start()
+			threads.append(t)
+	for t in threads: t.join()
+	positive_ttl, negative_ttl = get_hash_ttls()
+	for provider in providers:
+		if not fetched[provider]: continue
+		# Failed batches are left out so they are asked again next time
+		scrapecore.cache_hashes(provider, fetched[provider], positive_ttl, negative_ttl)
+		results[provider].update(fetched[provider])
+	return results
+
+"""
+	HashBroker
+	Aggregates the instant availability checks of all torrent scrapers in a search.
+	Each scraper submits its hashes with check(). Hashes are collected until every expected scraper has submitted
+	or HASH_BATCH_WINDOW has passed, then deduplicated and sent as one set of batched requests per provider.
+	Hashes already answered or in flight are never sent twice, and every waiting scraper receives the shared answer.
+"""
+
+class HashBroker(object):
+	def __init__(self, expected=0, window=HASH_BATCH_WINDOW):
+		self.expected = expected
+		self.window = window
+		self.submitted = 0
+		self.known = dict([(p, {}) for p in PROVIDERS])
+		self.resolved = set()
+		self.pending = set()
+		self.inflight = set()
+		self._timer = None
+		self._condition = threading.Condition()
+
+	def flush(self):
+		with self._condition:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			batch = list(self.pending)
+			self.pending.clear()
+			self.inflight.update(batch)
+		if not batch: return
+		results = check_hashes(batch)
+		with self._condition:
+			for provider in PROVIDERS:
+				self.known[provider].update(results[provider])
+			self.resolved.update(batch)
+			self.inflight.difference_update(batch)
+			self._condition.notify_all()
+
+	def check(self, hashes, timeout=HASH_CHECK_TIMEOUT):
+		hashes = normalize_hashes(hashes)
+		flush = False
+		with self._condition:
+			self.submitted += 1
+			self.pending.update([h for h in hashes if h not in self.resolved and h not in self.inflight])
+			if self.submitted >= self.expected:
+				flush = True
+			elif self._timer is None and self.pending:
+				self._timer = threading.Timer(self.window, self.flush)
+				self._timer.daemon = True
+				self._timer.start()
+		if flush: self.flush()
+		deadline = time.time() + timeout
+		with self._condition:
+			while not self.resolved.issuperset(hashes):
+				remaining = deadline - time.time()
+				if remaining <= 0: break
+				self._condition.wait(remaining)
+			return dict([(p, dict([(h, self.known[p].get(h, False)) for h in hashes])) for p in PROVIDERS])
+
+"""
+	HostRegistry
+	The hosts supported by each debrid provider, shared by every premium scraper.
+	Host lists are kept in memory and in addon_data/hosts.json for HOSTS_TTL seconds.
+	A provider with no list is fetched on first use. An expired list is still returned while a background thread refreshes it.
+	Only one fetch per provider runs at a time: concurrent callers wait up to HOSTS_WAIT seconds for it rather than
+	fetching too, and an empty or failed answer is remembered for HOSTS_RETRY seconds.
+	Lists are frozensets of lower case domains. match() looks up each parent domain of a host,
+	so www.host.com and cdn.host.com match host.com without scanning the list.
+"""
+
+class HostRegistry(object):
+	def __init__(self, ttl=HOSTS_TTL):
+		self.ttl = ttl
+		self.hosts = dict([(p, frozenset()) for p in PROVIDERS])
+		self.updated = dict([(p, 0) for p in PROVIDERS])
+		self.failed = dict([(p, 0) for p in PROVIDERS])
+		self.loaded = False
+		self._refreshing = {}
+		self._lock = threading.Lock()
+
+	def load(self):
+		self.loaded = True
+		try:
+			saved = json.loads(kodi.vfs.read_file(HOSTS_FILE))
+			for provider in PROVIDERS:
+				if provider not in saved: continue
+				self.hosts[provider] = frozenset(saved[provider]['hosts'])
+				self.updated[provider] = saved[provider]['updated']
+		except: pass
+
+	def save(self):
+		saved = dict([(p, {"hosts": list(self.hosts[p]), "updated": self.updated[p]}) for p in PROVIDERS])
+		try:
+			kodi.vfs.write_file(HOSTS_FILE, json.dumps(saved))
+		except Exception, e:
+			kodi.log(e)
+
+	""" Returns (event set when the provider's fetch completes, True if the caller should run that fetch) """
+	def begin_refresh(self, provider):
+		with self._lock:
+			done = self._refreshing.get(provider)
+			if done is not None: return done, False
+			done = self._refreshing[provider] = threading.Event()
+			return done, True
+
+	def refresh(self, provider):
+		try:
+			hosts = get_provider(provider).get_hosts()
+			if hosts:
+				self.hosts[provider] = frozenset([self.normalize(h) for h in hosts])
+				self.updated[provider] = time.time()
+				with self._lock:
+					self.save()
+			else:
+				self.failed[provider] = time.time()
+		except Exception, e:
+			kodi.log(e)
+			self.failed[provider] = time.time()
+		finally:
+			with self._lock:
+				done = self._refreshing.pop(provider, None)
+			if done is not None: done.set()
+
+	def refresh_async(self, provider):
+		done, leader = self.begin_refresh(provider)
+		if not leader: return
+		t = threading.Thread(target=self.refresh, args=(provider,))
+		t.daemon = True
+		t.start()
+
+	def get(self, provider):
+		if kodi.get_setting('%s_enable' % provider, ADDON_ID) != 'true': return frozenset()
+		if not self.loaded:
+			with self._lock:
+				if not self.loaded: self.load()
+		if not self.hosts[provider]:
+			if time.time() - self.failed[provider] < HOSTS_RETRY: return self.hosts[provider]
+			done, leader = self.begin_refresh(provider)
+			if leader:
+				self.refresh(provider)
+			else:
+				done.wait(HOSTS_WAIT)
+		elif time.time() - self.updated[provider] > self.ttl:
+			self.refresh_async(provider)
+		return self.hosts[provider]
+
+	def get_all(self):
+		return frozenset().union(*[self.get(p) for p in PROVIDERS])
+
+	@staticmethod
+	def normalize(host):
+		host = host.lower().strip('.')
+		if host.startswith('www.'): host = host[4:]
+		return host
+
+	@staticmethod
+	def match(host, hosts):
+		if not host or not hosts: return False
+		labels = HostRegistry.normalize(host).split('.')
+		for i in xrange(len(labels) - 1):
+			if '.'.join(labels[i:]) in hosts: return True
+		return False
+
+hosts = HostRegistry()
+
+"""
+	Resolving
+	A resolver is a (priority, name, function) tuple. The function is called with the url and a cancel event and
+	returns (resolved_url, playback_id, transfer_id), where transfer_id is the transfer it created, if any.
+
+	resolve_in_order tries the resolvers one after another, highest priority first.
+	race starts them all at once. When the first one succeeds it waits up to the grace window for a higher priority
+	resolver to succeed too, then returns the highest priority success. The losers are told to cancel and
+	cleanup is called for each transfer they created, including those that finish after the race is decided.
+"""
+
+def race_enabled():
+	return kodi.get_setting('resolve_mode', ADDON_ID) == 'race'
+
+def get_race_grace():
+	try: return float(kodi.get_setting('race_grace', ADDON_ID))
+	except: return RACE_GRACE
+
+def rank_resolvers(resolvers):
+	def priority(resolver):
+		try: return -float(resolver[0])
+		except: return 0
+	return sorted(resolvers, key=priority)
+
+def succeeded(result):
+	return bool(result and result[0])
+
+def resolve_in_order(resolvers, url):
+	for priority, name, func in rank_resolvers(resolvers):
+		try:
+			result = func(url, threading.Event())
+		except Exception, e:
+			kodi.log(e)
+			continue
+		if succeeded(result): return name, result
+	return None, None
+
+def resolve(resolvers, url, cleanup=None):
+	if race_enabled(): return race(resolvers, url, cleanup)
+	return resolve_in_order(resolvers, url)
+
+def race(resolvers, url, cleanup=None, grace=None):
+	if grace is None: grace = get_race_grace()
+	ranked = [r[1] for r in rank_resolvers(resolvers)]
+	results = {}
+	state = {"decided": False}
+	canceled = threading.Event()
+	condition = threading.Condition()
+
+	def release(name, result):
+		if cleanup is None or not result or not result[2]: return
+		try:
+			cleanup(name, result)
+		except Exception, e:
+			kodi.log(e)
+
+	def run(name, func):
+		try:
+			result = func(url, canceled)
+		except Exception, e:
+			kodi.log(e)
+			result = None
+		with condition:
+			results[name] = result
+			decided = state['decided']
+			condition.notify_all()
+		if decided: release(name, result)
+
+	for priority, name, func in resolvers:
+		t = threading.Thread(target=run, args=(name, func))
+		t.daemon = True
+		t.start()
+
+	first_success = None
+	with condition:
+		while True:
+			successes = [n for n in ranked if succeeded(results.get(n))]
+			winner = successes[0] if successes else None
+			# Resolvers ranked above the best success so far that may still beat it
+			above = ranked[:ranked.index(winner)] if winner is not None else ranked
+			waiting = [n for n in above if n not in results]
+			if not waiting: break
+			if winner is None:
+				condition.wait(1)
+				continue
+			if first_success is None: first_success = time.time()
+			remaining = first_success + grace - time.time()
+			if remaining <= 0: break
+			condition.wait(remaining)
+		state['decided'] = True
+		canceled.set()
+		finished = results.items()
+	for name, result in finished:
+		if name != winner: release(name, result)
+	if winner is None: return None, None
+	return winner, results[winner]
+
+"""
+	TransferPoller
+	Waits for Premiumize transfers to finish. Every pending resolve registers its transfer id with wait(), and a single
+	thread calls list_transfers once per tick and hands each waiter its own transfer.
+	The first tick comes after TRANSFER_FIRST_POLL seconds and each following one twice as late, up to TRANSFER_MAX_POLL.
+	A new waiter resets the interval: the next tick is at most TRANSFER_FIRST_POLL seconds away, however often waiters register.
+	Each waiter gives up after its own deadline, transfer_deadline seconds by default,
+	or when it is canceled. The progress callback receives the transfer each time its status is fetched.
+"""
+
+def get_transfer_deadline():
+	try: return float(kodi.get_setting('transfer_deadline', ADDON_ID))
+	except: return TRANSFER_DEADLINE
+
+class TransferWaiter(object):
+	def __init__(self, id):
+		self.id = id
+		self.transfer = None
+		self.finished = False
+		self.done = threading.Event()
+		self.updated = threading.Event()
+
+class TransferPoller(object):
+	def __init__(self, first_poll=TRANSFER_FIRST_POLL, max_poll=TRANSFER_MAX_POLL):
+		self.first_poll = first_poll
+		self.max_poll = max_poll
+		self.ticks = 0
+		self._reset = False
+		self._waiters = {}
+		self._thread = None
+		self._condition = threading.Condition()
+
+	def poll(self):
+		try:
+			transfers = get_provider('premiumize').list_transfers()['transfers']
+		except Exception, e:
+			kodi.log(e)
+			return
+		self.ticks += 1
+		transfers = dict([(t['id'], t) for t in transfers])
+		with self._condition:
+			for id, waiters in self._waiters.items():
+				if id not in transfers: continue
+				transfer = transfers[id]
+				for waiter in waiters:
+					waiter.transfer = transfer
+					waiter.finished = transfer['status'] == 'finished'
+					if waiter.finished or transfer['status'] in TRANSFER_FAILED: waiter.done.set()
+					waiter.updated.set()
+
+	def run(self):
+		delay = self.first_poll
+		next_poll = time.time() + delay
+		while True:
+			with self._condition:
+				while True:
+					if not self._waiters:
+						self._thread = None
+						return
+					if self._reset:
+						# A new waiter restarts the short interval, it can bring the next tick closer but never push it back
+						self._reset = False
+						delay = self.first_poll
+						next_poll = min(next_poll, time.time() + delay)
+					remaining = next_poll - time.time()
+					if remaining <= 0: break
+					self._condition.wait(remaining)
+			self.poll()
+			delay = min(delay * 2, self.max_poll)
+			next_poll = time.time() + delay
+
+	def register(self, waiter):
+		with self._condition:
+			self._waiters.setdefault(waiter.id, []).append(waiter)
+			self._reset = True
+			self._condition.notify_all()
+			if self._thread is None:
+				self._thread = threading.Thread(target=self.run)
+				self._thread.daemon = True
+				self._thread.start()
+
+	def unregister(self, waiter):
+		with self._condition:
+			waiters = self._waiters.get(waiter.id, [])
+			if waiter in waiters: waiters.remove(waiter)
+			if not waiters: self._waiters.pop(waiter.id, None)
+
+	""" Blocks until the transfer is finished and returns it, or returns None if it failed, was canceled or the deadline passed """
+	def wait(self, id, timeout=None, canceled=None, progress=None):
+		if timeout is None: timeout = get_transfer_deadline()
+		deadline = time.time() + timeout
+		waiter = TransferWaiter(id)
+		self.register(waiter)
+		try:
+			while not waiter.done.is_set():
+				remaining = deadline - time.time()
+				if remaining <= 0 or (canceled is not None and canceled.is_set()): break
+				waiter.updated.wait(min(remaining, 0.25))
+				if waiter.updated.is_set():
+					waiter.updated.clear()
+					if progress is not None: progress(waiter.transfer)
+		finally:
+			self.unregister(waiter)
+		return waiter.transfer if waiter.finished else None
+
+transfers = TransferPoller()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import re
+from itertools import islice
+
+"""
+	Streaming tag extraction
+	A replacement for commoncore.dom_parser.parse_dom(html, name, attrs, ret).
+	The document is scanned once for the opening and closing tags of name only. Opening tags are matched against attrs
+	as they are found, and each match is yielded as soon as it is complete:
+		ret a string	the value of the ret attribute, as soon as the opening tag is read
+		ret True		the outer html, opening and closing tag included, once the matching closing tag is found
+		ret False		the inner html, once the matching closing tag is found, nested tags of the same name included
+	A self closing tag (<div ... />) is complete at once, its inner html is empty.
+	Matches are yielded in document order. iter_dom is a generator, so a caller that needs only the first matches
+	stops the scan early: parse_dom(html, 'a', ret='href', limit=1) reads up to the first link only.
+
+	The results are the same as dom_parser's except in the cases below, where dom_parser's regular expressions
+	matched more or less than the query asked for:
+		tag names		only <name followed by a space, / or > matches. dom_parser also matched longer names, <a matching <abbr
+		attribute names	are compared whole and case insensitively. dom_parser also matched names ending in the key, id matching data-id
+		attrs values	are regular expressions that must match the whole value of that attribute only.
+						dom_parser's pattern could run past the closing quote into later attributes and tags,
+						collapsing several elements into one match
+		no attrs		every <name> tag matches. dom_parser only matched bare <name> tags when the page had any
+		ret				a missing attribute yields nothing. dom_parser searched on past the end of the tag for it.
+						ret given as unicode is an attribute name, dom_parser treated it as True and returned outer html
+						ret True ends at the closing tag's >, dom_parser also took the character after it
+		unquoted values	run to the next space or >. dom_parser also cut them at the first /
+		self closing	tags are complete at once. dom_parser took the content up to the next closing tag
+"""
+
+ATTRIBUTE = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+# A / ending the tag, not an unquoted value such as href=/movies/
+SELF_CLOSING = re.compile(r'(?:^|[\s"\'])/\Z')
+# Compiled patterns are kept for the PATTERN_CACHE most recent tag names and attribute values, then dropped, as re does
+PATTERN_CACHE = 100
+_tag_patterns = {}
+_value_patterns = {}
+
+def get_pattern(cache, key, source, flags=0):
+	pattern = cache.get(key)
+	if pattern is None:
+		if len(cache) >= PATTERN_CACHE: cache.clear()
+		pattern = cache[key] = re.compile(source, flags)
+	return pattern
+
+def get_tag_pattern(name):
+	return get_pattern(_tag_patterns, name, r'<(/?)%s(?=[\s/>])([^>]*)>' % re.escape(name))
+
+def get_value_pattern(value):
+	return get_pattern(_value_patterns, value, r'(?:%s)\Z' % value, re.S)
+
+def get_attributes(tag):
+	attributes = {}
+	for key, double, single, bare in ATTRIBUTE.findall(tag):
+		key = key.lower()
+		if key not in attributes: attributes[key] = double or single or bare
+	return attributes
+
+def match_attributes(attributes, attrs):
+	for key, value in attrs.iteritems():
+		if key.lower() not in attributes: return False
+		if not get_value_pattern(value).match(attributes[key.lower()]): return False
+	return True
+
+def iter_dom(html, name, attrs={}, ret=False):
+	pattern = get_tag_pattern(name)
+	attribute = ret.lower() if isinstance(ret, basestring) else None
+	outer = ret is True
+	# Open elements as [matched slot or None, start of the opening tag, end of the opening tag]
+	stack = []
+	# Contents of matched elements in document order, None until their closing tag is found
+	slots = []
+	emitted = 0
+	for tag in pattern.finditer(html):
+		closing, body = tag.group(1), tag.group(2)
+		if closing:
+			if not stack: continue
+			slot, start, end = stack.pop()
+			if slot is None: continue
+			slots[slot] = html[start:tag.end()] if outer else html[end:tag.start()].strip()
+			while emitted < len(slots) and slots[emitted] is not None:
+				yield slots[emitted]
+				emitted += 1
+			continue
+		attributes = get_attributes(body) if attrs or attribute else None
+		matched = not attrs or match_attributes(attributes, attrs)
+		if attribute:
+			if matched and attribute in attributes: yield attributes[attribute].strip()
+			continue
+		if SELF_CLOSING.search(body):
+			if matched:
+				slots.append(tag.group(0) if outer else u'')
+				while emitted < len(slots) and slots[emitted] is not None:
+					yield slots[emitted]
+					emitted += 1
+			continue
+		stack.append([len(slots) if matched else None, tag.start(), tag.end()])
+		if matched: slots.append(None)
+	# Elements never closed run to the end of the document
+	for slot, start, end in stack:
+		if slot is not None: slots[slot] = html[start:] if outer else html[end:].strip()
+	for content in slots[emitted:]:
+		yield content
+
+def parse_dom(html, name=u"", attrs={}, ret=False, limit=None):
+	if isinstance(html, str):
+		try: html = [html.decode("utf-8")]
+		except: html = [html]
+	elif isinstance(html, unicode): html = [html]
+	elif not isinstance(html, list): return u""
+	if not name.strip(): return u""
+	results = []
+	for item in html:
+		remaining = None if limit is None else limit - len(results)
+		if remaining is not None and remaining <= 0: break
+		results += list(islice(iter_dom(item, name, attrs, ret), remaining))
+	return results
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import time
+import Queue
+import threading
+from commoncore import kodi
+
+"""
+	The shared executor
+	A single, fixed size set of worker threads shared by every scraper in the process.
+	With the default ThreadPool path each scraper starts its own pool of VERIFY_POOLS_SIZE threads,
+	so a search over many scrapers runs hundreds of mostly idle threads. With the shared executor the
+	verify work of all scrapers is queued to the same workers and the thread count stays constant.
+
+	TaskGroup exposes the same queueTask / joinAll interface as commoncore.threadpool.ThreadPool,
+	so existing synchronous scrapers run unchanged.
+"""
+
+class TaskGroup(object):
+	def __init__(self, executor):
+		self.executor = executor
+		self.pending = 0
+		self._condition = threading.Condition()
+
+	def queueTask(self, task, args=None, taskCallback=None):
+		with self._condition:
+			self.pending += 1
+		self.executor.submit(self, task, args, taskCallback)
+
+	def task_done(self):
+		with self._condition:
+			self.pending -= 1
+			if self.pending == 0: self._condition.notify_all()
+
+	def joinAll(self, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		with self._condition:
+			while self.pending > 0:
+				if deadline is None:
+					self._condition.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0: break
+					self._condition.wait(remaining)
+			return self.pending == 0
+
+class SharedExecutor(object):
+	def __init__(self, size):
+		self.size = size
+		self._queue = Queue.Queue()
+		self._workers = []
+		self._lock = threading.Lock()
+
+	def _start(self):
+		with self._lock:
+			while len(self._workers) < self.size:
+				worker = threading.Thread(target=self._work)
+				worker.daemon = True
+				worker.start()
+				self._workers.append(worker)
+
+	def _work(self):
+		while True:
+			group, task, args, callback = self._queue.get()
+			try:
+				result = task(args) if args is not None else task()
+				if callback is not None: callback(result)
+			except Exception, e:
+				kodi.log(e)
+			finally:
+				group.task_done()
+
+	def submit(self, group, task, args=None, callback=None):
+		if len(self._workers) < self.size: self._start()
+		self._queue.put((group, task, args, callback))
+
+	def group(self):
+		return TaskGroup(self)
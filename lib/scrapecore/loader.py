@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import os
+import sys
+import imp
+import json
+import time
+import marshal
+import hashlib
+import inspect
+import threading
+import xbmc
+from commoncore import kodi
+
+"""
+	The scraper loader
+	Scraper files are no longer executed on every plugin invocation.
+	A manifest of every scraper file is kept in addon_data, keyed by path and validated by mtime and size:
+		service, name, module		as defined by the scraper
+		capabilities				which of search_movies, search_shows, list_* the scraper defines
+		base						the scrapecore.scrapers.common class that defines valid, or None if the scraper defines its own
+		settings_definition			used to install the scraper
+	Unchanged scrapers are represented by a LazyScraper built from the manifest. The module is only
+	executed the first time an attribute other than the manifest fields is needed, typically when a search calls it.
+	installed lists the scrapers to register: the new and changed ones, and unchanged ones whose service is missing
+	from the registered services passed to load, e.g. after core.db was recreated or the scraper uninstalled.
+	Compiled code objects are cached in addon_data/bytecode so a changed file is compiled once.
+"""
+
+ADDON_ID = 'script.module.scrapecore'
+DATA_PATH = "special://home/userdata/addon_data/script.module.scrapecore"
+MANIFEST_FILE = kodi.vfs.join(DATA_PATH, 'scrapers.json')
+BYTECODE_PATH = kodi.vfs.join(DATA_PATH, 'bytecode')
+if not kodi.vfs.exists(BYTECODE_PATH): kodi.vfs.mkdir(BYTECODE_PATH)
+MANIFEST_VERSION = 1
+CAPABILITIES = ['search_movies', 'search_shows', 'list_shows', 'list_movies', 'list_episodes']
+IGNORE_LIST = ['__init__.py', '__all__.py', 'common.py', 'example.py']
+
+class LazyScraper(object):
+	def __init__(self, loader, entry):
+		self.__dict__['_loader'] = loader
+		self.__dict__['_entry'] = entry
+		self.__dict__['_instance'] = None
+		self.__dict__['_pending'] = {}
+		self.__dict__['service'] = entry['service']
+		self.__dict__['name'] = entry['name']
+		self.__dict__['settings_definition'] = entry['settings_definition']
+
+	def __dir__(self):
+		if self._instance is not None: return dir(self._instance)
+		return ['service', 'name', 'valid'] + self._entry['capabilities']
+
+	@property
+	def valid(self):
+		if self._instance is None and self._entry['base']:
+			return self._loader.base_valid(self._entry['base'])
+		return self.get_instance().valid
+
+	def get_instance(self):
+		if self._instance is None:
+			with self._loader.lock:
+				if self._instance is None:
+					instance = self._loader.load_scraper(self._entry)
+					for k, v in self._pending.iteritems():
+						setattr(instance, k, v)
+					self.__dict__['_instance'] = instance
+		return self._instance
+
+	def __getattr__(self, name):
+		if name.startswith('__'): raise AttributeError(name)
+		if name in self._pending: return self._pending[name]
+		return getattr(self.get_instance(), name)
+
+	def __setattr__(self, name, value):
+		if self._instance is None:
+			self._pending[name] = value
+		else:
+			setattr(self._instance, name, value)
+
+class ScraperLoader(object):
+	def __init__(self, namespace):
+		self.namespace = namespace
+		self.lock = threading.RLock()
+		self.manifest = {}
+		self.changed = False
+		self.installed = []
+		try:
+			manifest = json.loads(kodi.vfs.read_file(MANIFEST_FILE))
+			if manifest['version'] == MANIFEST_VERSION:
+				self.manifest = manifest['scrapers']
+		except: pass
+
+	def base_valid(self, base):
+		from scrapers import common
+		return getattr(common, base).valid
+
+	def get_code(self, path, mtime):
+		if type(path) == unicode: path = path.encode('utf-8')
+		cache_file = xbmc.translatePath(kodi.vfs.join(BYTECODE_PATH, hashlib.sha1(path).hexdigest()))
+		try:
+			with open(cache_file, 'rb') as f:
+				if f.read(4) == imp.get_magic() and marshal.load(f) == mtime:
+					return marshal.load(f)
+		except: pass
+		code = compile(kodi.vfs.read_file(path), path, 'exec')
+		try:
+			with open(cache_file, 'wb') as f:
+				f.write(imp.get_magic())
+				marshal.dump(mtime, f)
+				marshal.dump(code, f)
+		except: pass
+		return code
+
+	def exec_scraper(self, path, name, mtime):
+		# Each scraper runs in a copy of the scrapers package namespace, as it did when executed in place
+		namespace = dict(self.namespace)
+		exec self.get_code(path, mtime) in namespace
+		return namespace[name + 'Scraper']
+
+	def load_scraper(self, entry):
+		klass = self.exec_scraper(entry['path'], entry['module'], entry['mtime'])
+		return klass()
+
+	def describe(self, path, name, stat, klass, scraper):
+		base = None
+		for c in inspect.getmro(klass):
+			if 'valid' in c.__dict__:
+				if c.__module__ == 'scrapecore.scrapers.common': base = c.__name__
+				break
+		return {
+			"path": path,
+			"module": name,
+			"mtime": stat.st_mtime,
+			"size": stat.st_size,
+			"service": scraper.service,
+			"name": scraper.name,
+			"capabilities": [c for c in CAPABILITIES if c in dir(scraper)],
+			"base": base,
+			"settings_definition": scraper.settings_definition
+		}
+
+	def load(self, resources, exception_class=Exception, registered=None):
+		start = time.time()
+		scrapers = []
+		seen = set()
+		for mod in resources:
+			path = kodi.vfs.join(mod['path'], 'scrapers')
+			sys.path.append(path)
+			for filename in sorted(os.listdir(path)):
+				test = filename.lower()
+				if test in IGNORE_LIST or not test.endswith('.py'): continue
+				name = filename[0:len(filename)-3]
+				scraper_path = kodi.vfs.join(path, filename)
+				seen.add(scraper_path)
+				stat = os.stat(scraper_path)
+				entry = self.manifest.get(scraper_path)
+				if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+					if 'invalid' in entry: continue
+					lazy = LazyScraper(self, entry)
+					if registered is not None and entry['service'] not in registered: self.installed.append(lazy)
+					scrapers.append(lazy)
+					continue
+				# New or changed scraper, execute it once to update the manifest
+				self.changed = True
+				try:
+					klass = self.exec_scraper(scraper_path, name, stat.st_mtime)
+				except exception_class as e:
+					kodi.log(e)
+					kodi.log("Invalid scraper: %s" % name)
+					self.manifest[scraper_path] = {"mtime": stat.st_mtime, "size": stat.st_size, "invalid": True}
+					continue
+				scraper = klass()
+				entry = self.describe(scraper_path, name, stat, klass, scraper)
+				self.manifest[scraper_path] = entry
+				self.installed.append(scraper)
+				lazy = LazyScraper(self, entry)
+				lazy.__dict__['_instance'] = scraper
+				scrapers.append(lazy)
+		for scraper_path in self.manifest.keys():
+			if scraper_path not in seen:
+				del self.manifest[scraper_path]
+				self.changed = True
+		if self.changed: self.save()
+		kodi.log("Loaded %s scrapers in %.3f seconds" % (len(scrapers), time.time() - start))
+		return scrapers
+
+	def save(self):
+		kodi.vfs.write_file(MANIFEST_FILE, json.dumps({"version": MANIFEST_VERSION, "scrapers": self.manifest}))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import time
+import threading
+from commoncore import kodi
+from executor import SharedExecutor
+
+"""
+	Prefetching
+	Once a search has sorted its sources, the top prefetch_count sources from scrapers with prefetch = True
+	are resolved in the background by PREFETCH_WORKERS threads.
+	Each resolved source is kept as (url, properties) for RESOLVED_TTL seconds, keyed by raw_url.
+	Selecting a prefetched source plays at once. Selecting one that is still resolving waits for that resolve
+	rather than starting a second one.
+	Only scrapers whose resolve has no side effects set prefetch, torrent scrapers do not since each resolve
+	creates a transfer on the debrid account that nothing would delete.
+	Prefetching follows search (and cached results), iter_search yields unsorted sources as they arrive and does not prefetch.
+"""
+
+ADDON_ID = 'script.module.scrapecore'
+PREFETCH_WORKERS = 2
+RESOLVED_TTL = 600
+RESOLVED_MAX = 50
+
+def prefetch_enabled():
+	return kodi.get_setting('prefetch_enable', ADDON_ID) == 'true'
+
+def get_prefetch_count():
+	try: return int(kodi.get_setting('prefetch_count', ADDON_ID))
+	except: return 3
+
+class ResolvedCache(object):
+	def __init__(self, ttl=RESOLVED_TTL, max_entries=RESOLVED_MAX):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self._entries = {}
+		self._lock = threading.Lock()
+
+	def get(self, raw_url):
+		with self._lock:
+			entry = self._entries.get(raw_url)
+			if entry is None: return None
+			if entry[0] < time.time():
+				del self._entries[raw_url]
+				return None
+			return entry[1]
+
+	def set(self, raw_url, resolved):
+		with self._lock:
+			now = time.time()
+			for k in [k for k, v in self._entries.items() if v[0] < now]:
+				del self._entries[k]
+			if len(self._entries) >= self.max_entries:
+				oldest = min(self._entries.items(), key=lambda e: e[1][0])[0]
+				del self._entries[oldest]
+			self._entries[raw_url] = (now + self.ttl, resolved)
+
+	def delete(self, raw_url):
+		with self._lock:
+			self._entries.pop(raw_url, None)
+
+class Prefetcher(object):
+	def __init__(self, workers=PREFETCH_WORKERS):
+		self.executor = SharedExecutor(workers)
+		self.cache = ResolvedCache()
+		self._inflight = {}
+		self._lock = threading.Lock()
+
+	def resolve(self, args):
+		scraper, raw_url = args
+		try:
+			url, properties = scraper.resolve_source(raw_url)
+			if url: self.cache.set(raw_url, (url, properties))
+		except Exception, e:
+			kodi.log(e)
+		finally:
+			with self._lock:
+				done = self._inflight.pop(raw_url, None)
+			if done is not None: done.set()
+
+	def prefetch(self, sources, get_scraper, count=None):
+		if count is None: count = get_prefetch_count()
+		group = self.executor.group()
+		queued = 0
+		for source in sources:
+			if queued >= count: break
+			try:
+				scraper = get_scraper(source['service'])
+			except KeyError:
+				continue
+			if not scraper.prefetch: continue
+			queued += 1
+			raw_url = source['raw_url']
+			with self._lock:
+				if raw_url in self._inflight or self.cache.get(raw_url) is not None: continue
+				self._inflight[raw_url] = threading.Event()
+			group.queueTask(self.resolve, args=(scraper, raw_url))
+		return queued
+
+	""" The prefetched (url, properties) of raw_url, waiting up to timeout for a resolve in progress """
+	def get(self, raw_url, timeout=30):
+		with self._lock:
+			done = self._inflight.get(raw_url)
+		if done is not None: done.wait(timeout)
+		return self.cache.get(raw_url)
+
+prefetcher = Prefetcher()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
+
+"""
+	Rate limiting
+	Every domain gets a token bucket holding up to burst tokens, refilled at rate tokens per second.
+	A request takes one token, when the bucket is empty it reserves the next token and waits for it,
+	so concurrent requests to one domain are spaced out in the order they arrived instead of all being sent at once.
+	The bucket is kept as the time it will be full again, which makes a reservation a single addition.
+	pause() stops a domain for a number of seconds, e.g. the Retry-After of a 429, for every scraper using it.
+	Scrapers sharing a domain share its bucket, the strictest rate and burst configured for it apply.
+	Counts are kept per group (the scraper service): requests delayed for a token, throttled by the server, and failed.
+"""
+
+MAX_PAUSE = 120
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+def get_domain(url):
+	return urlparse(url).netloc.lower()
+
+""" Seconds to wait from a Retry-After header, either a number of seconds or an http date. None when absent or unreadable """
+def parse_retry_after(value):
+	if not value: return None
+	value = value.strip()
+	if value.isdigit(): return min(int(value), MAX_PAUSE)
+	try:
+		return min(max(mktime_tz(parsedate_tz(value)) - time.time(), 0), MAX_PAUSE)
+	except:
+		return None
+
+""" Exponential backoff with full jitter: a random delay up to BACKOFF_BASE * 2^attempt, capped at BACKOFF_MAX """
+def get_backoff(attempt):
+	return random.uniform(0, min(BACKOFF_BASE * (2 ** attempt), BACKOFF_MAX))
+
+class TokenBucket(object):
+	def __init__(self, rate, burst):
+		self.full_at = 0
+		self._lock = threading.Lock()
+		self.configure(rate, burst)
+
+	def configure(self, rate, burst):
+		self.rate = float(rate)
+		self.burst = max(int(burst), 1)
+		self.interval = 1 / self.rate
+		self.capacity = self.burst * self.interval
+
+	""" Reserves a token and returns the seconds to wait for it, or None without reserving when that is longer than timeout """
+	def reserve(self, timeout=None):
+		with self._lock:
+			now = time.time()
+			full_at = max(self.full_at, now)
+			wait = max(full_at + self.interval - self.capacity - now, 0)
+			if timeout is not None and wait > timeout: return None
+			self.full_at = full_at + self.interval
+			return wait
+
+	def pause(self, seconds):
+		with self._lock:
+			until = time.time() + min(seconds, MAX_PAUSE)
+			self.full_at = max(self.full_at, until + self.capacity - self.interval)
+
+class RateLimiter(object):
+	def __init__(self):
+		self.counts = {}
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def get_bucket(self, domain, rate, burst):
+		with self._lock:
+			bucket = self._buckets.get(domain)
+			if bucket is None:
+				bucket = self._buckets[domain] = TokenBucket(rate, burst)
+			elif rate < bucket.rate or burst < bucket.burst:
+				bucket.configure(min(rate, bucket.rate), min(burst, bucket.burst))
+			return bucket
+
+	""" Seconds to wait before sending to url, None when the wait would be longer than timeout. No limit when rate is falsy """
+	def acquire(self, url, rate, burst, timeout=None, group=None):
+		if not rate: return 0
+		wait = self.get_bucket(get_domain(url), rate, burst).reserve(timeout)
+		if wait: self.count(group, 'delayed')
+		return wait
+
+	def pause(self, url, seconds):
+		with self._lock:
+			bucket = self._buckets.get(get_domain(url))
+		if bucket is not None: bucket.pause(seconds)
+
+	def count(self, group, key):
+		with self._lock:
+			counts = self.counts.setdefault(group, {"delayed": 0, "throttled": 0, "failed": 0})
+			counts[key] += 1
+
+	def stats(self, group=None):
+		with self._lock:
+			if group is not None:
+				return dict(self.counts.get(group, {"delayed": 0, "throttled": 0, "failed": 0}))
+			return dict([(k, dict(v)) for k, v in self.counts.items()])
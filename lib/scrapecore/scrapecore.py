@@ -15,9 +15,13 @@
 	along with this program.  If not, see <http://www.gnu.org/licenses/>.
 *'''
 import re
+import time
+import sqlite3
+import threading
+import xbmc
 from commoncore import kodi
 from commoncore.baseapi import DB_CACHABLE_API, EXPIRE_TIMES
-from database import DB
+from database import DB, DB_FILE
 from commoncore.BeautifulSoup import BeautifulSoup
 orig_prettify = BeautifulSoup.prettify
 def prettify(encoding=None, indent_width=4):
@@ -69,6 +73,9 @@ def get_installed_resources():
 			results.append(a)
 	return results
 
+def get_registered_services():
+	return set([r['service'] for r in DB.query_assoc("SELECT service FROM scrapers", force_double_array=True)])
+
 def get_scrapers():
 	return DB.query_assoc("SELECT scraper_id, name, service, enabled FROM scrapers ORDER by name DESC", force_double_array=True)
 
@@ -92,21 +99,97 @@ def get_scraper_info_by_id(id):
 		return info
 	else: return False
 
-def install_scraper(scraper):
+def format_settings_definition(scraper):
+	settings_definition = ''
+	for s in scraper.settings_definition:
+		settings_definition += "\n\t\t" + s
+	settings_definition = settings_definition.replace("{NAME}", scraper.name)
+	settings_definition = settings_definition.replace("{SERVICE}", scraper.service)
+	return settings_definition
+
+"""
+	install_scrapers registers a list of scrapers in a single transaction
+	New scrapers are inserted enabled, existing scrapers have their name and settings definition updated.
+	The settings file is then rewritten if its content changed.
+"""
+def install_scrapers(scrapers):
+	if not scrapers: return
 	DB.connect()
-	scraper_id = DB.query("SELECT scraper_id FROM scrapers WHERE service=?", [scraper.service])
-	if not scraper_id:
-		kodi.set_property("new_scraper", "true", 'script.module.scrapecore')
-		settings_definition = ''
-		for s in scraper.settings_definition:
-			settings_definition += "\n\t\t" + s
-		settings_definition = settings_definition.replace("{NAME}", scraper.name)
-		settings_definition = settings_definition.replace("{SERVICE}", scraper.service)
-		DB.execute("INSERT INTO scrapers(service, name, settings, enabled) VALUES(?,?,?,1)", [scraper.service, scraper.name, settings_definition])
-		DB.commit()
+	for scraper in scrapers:
+		settings_definition = format_settings_definition(scraper)
+		DB.execute("INSERT OR IGNORE INTO scrapers(service, name, settings, enabled) VALUES(?,?,?,1)", [scraper.service, scraper.name, settings_definition])
+		DB.execute("UPDATE scrapers SET name=?, settings=? WHERE service=?", [scraper.name, settings_definition, scraper.service])
+	DB.commit()
+	write_settings_file()
+
+def install_scraper(scraper):
+	install_scrapers([scraper])
+
+"""
+	The scraper statistics and hash_cache are read and written from searches running on any thread: the hash broker,
+	scraper workers and background result refreshes, not only the main thread that owns DB.
+	Each thread opens its own connection to core.db, sqlite connections can not be shared between threads.
+	The tables themselves are created with the rest of the schema by DB.
+"""
+thread_db = threading.local()
+def get_thread_db():
+	if getattr(thread_db, 'db', None) is None:
+		thread_db.db = sqlite3.connect(xbmc.translatePath(DB_FILE), timeout=10)
+	return thread_db.db
+
+"""
+	Scraper statistics
+	record_scraper_stats is called once after each search with a dict of per service stats:
+		{service: {"duration": seconds, "requests": n, "errors": 0|1, "timeouts": 0|1, "results": {quality: count}}}
+	Counters are accumulated in scraper_stats and scraper_quality_stats in a single transaction.
+"""
+def record_scraper_stats(stats):
+	if not stats: return
+	db = get_thread_db()
+	with db:
+		for service, s in stats.iteritems():
+			results = sum(s['results'].values())
+			db.execute("INSERT OR IGNORE INTO scraper_stats(service) VALUES(?)", [service])
+			db.execute("UPDATE scraper_stats SET searches=searches+1, requests=requests+?, errors=errors+?, timeouts=timeouts+?, results=results+?, duration=duration+?, last_duration=?, ts=CURRENT_TIMESTAMP WHERE service=?", [s['requests'], s['errors'], s['timeouts'], results, s['duration'], s['duration'], service])
+			for quality, count in s['results'].iteritems():
+				db.execute("INSERT OR IGNORE INTO scraper_quality_stats(service, quality) VALUES(?,?)", [service, quality])
+				db.execute("UPDATE scraper_quality_stats SET results=results+? WHERE service=? AND quality=?", [count, service, quality])
+
+def get_scraper_stats():
+	return DB.query_assoc("SELECT s.service, s.name, t.searches, t.requests, t.errors, t.timeouts, t.results, t.duration, t.last_duration FROM scraper_stats t JOIN scrapers s ON s.service=t.service ORDER BY s.name ASC", force_double_array=True)
+
+def get_scraper_quality_stats(service):
+	return DB.query_assoc("SELECT quality, results FROM scraper_quality_stats WHERE service=? ORDER BY quality DESC", [service], force_double_array=True)
+
+""" Services ordered by average results per search, highest first, then by average duration, fastest first """
+def get_scraper_ranking():
+	rows = get_thread_db().execute("SELECT service FROM scraper_stats WHERE searches > 0 ORDER BY (results * 1.0 / searches) DESC, (duration / searches) ASC").fetchall()
+	return [r[0] for r in rows]
+
+""" Unexpired instant availability answers for the hashes of one provider, as {hash: True|False} """
+def get_cached_hashes(provider, hashes):
+	db = get_thread_db()
+	cached = {}
+	# Stay below the sqlite limit on bound variables
+	for i in xrange(0, len(hashes), 500):
+		batch = hashes[i:i+500]
+		rows = db.execute("SELECT hash, cached FROM hash_cache WHERE provider=? AND expires > ? AND hash IN (%s)" % ','.join(['?'] * len(batch)), [provider, time.time()] + batch).fetchall()
+		for hash, value in rows: cached[hash] = value == 1
+	return cached
+
+def cache_hashes(provider, available, positive_ttl, negative_ttl):
+	db = get_thread_db()
+	now = time.time()
+	with db:
+		db.execute("DELETE FROM hash_cache WHERE expires <= ?", [now])
+		for hash, cached in available.iteritems():
+			expires = now + (positive_ttl if cached else negative_ttl)
+			db.execute("REPLACE INTO hash_cache(provider, hash, cached, expires) VALUES(?,?,?,?)", [provider, hash, 1 if cached else 0, expires])
 
 def delete_scraper(service):
 	DB.execute("DELETE FROM scrapers WHERE service=?", [service])
+	DB.execute("DELETE FROM scraper_stats WHERE service=?", [service])
+	DB.execute("DELETE FROM scraper_quality_stats WHERE service=?", [service])
 	DB.commit()
 	write_settings_file()
 
@@ -121,8 +204,14 @@ def build_settings():
 	settings = str(settings.replace("{SCRAPERS_CATEGORY}", block))
 	return settings
 
+""" The settings file is only written when the generated content differs from the file on disk """
 def write_settings_file():
 	settings_file = kodi.vfs.join("special://home", 'addons/%s/resources/settings.xml' % ADDON_ID)
 	settings = build_settings()
+	current = kodi.vfs.read_file(settings_file) if kodi.vfs.exists(settings_file) else None
+	if type(current) == unicode: current = current.encode('utf-8')
+	if current == settings:
+		return False
 	kodi.vfs.write_file(settings_file, settings)
+	return True
 
@@ -18,16 +18,23 @@
 import os
 import re
 import sys
+import copy
+import time
+import Queue
 import importlib
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from commoncore import kodi
 from commoncore.threadpool import ThreadPool
 from commoncore.kodi import ProgressBar
 from commoncore.core import format_size, format_color, highlight
 from scrapecore import scrapecore
+from scrapecore import cache
+from scrapecore import prefetch
+from scrapecore.loader import ScraperLoader, LazyScraper
+from scrapecore.debrid import HashBroker
+from scrapecore.scrapers.common import THREAD_POOL_SIZE, ScrapeCoreTimeout
 
 # Some path and general definitions
-THREAD_POOL_SIZE = 20
 THREAD_TIMEOUT = 15
 ADDON_ID = 'script.module.scrapecore'
 sys.path.append( os.path.dirname(os.path.abspath(__file__)).replace('scrapers', ''))
@@ -39,24 +46,84 @@ if not kodi.vfs.exists(kodi.vfs.join("special://home", 'addons/script.module.scr
 class ScrapeCoreException(Exception):
 	pass
 
-class ScrapeCoreTimeout(Exception):
-	pass
+"""
+	SearchSession
+	Holds all of the state of a single search: the result collector, the cancellation token (abort_event),
+	the deadline, progress and statistics.
+	Scrapers are bound to the session as shallow copies with their own verified_results, abort_event and deadline,
+	so searches running at the same time, or one after another, never share results or cancellation
+	and the memory of a search is released with its session.
+
+	The deadline is search_deadline seconds after the session starts (0 disables it).
+	A bound scraper's requests are capped to the time left and fail once it has passed. Results arriving later are dropped.
+"""
+
+class SearchSession(object):
+	def __init__(self):
+		try: seconds = float(kodi.get_setting('search_deadline', ADDON_ID))
+		except: seconds = 0
+		self.deadline = time.time() + seconds if seconds > 0 else None
+		self.abort_event = Event()
+		self.results = []
+		self.result_count = 0
+		self.completed = 0
+		self.total = 0
+		self.stats = {}
+		self.hash_broker = HashBroker()
+		self._lock = Lock()
+
+	def bind(self, scraper):
+		if isinstance(scraper, LazyScraper): scraper = scraper.get_instance()
+		bound = copy.copy(scraper)
+		bound.verified_results = []
+		bound.abort_event = self.abort_event
+		bound.deadline = self.deadline
+		bound.request_count = 0
+		bound.throttled_count = 0
+		bound.failed_count = 0
+		if bound.torrent:
+			# Torrent scrapers share one broker so their availability checks are sent together
+			bound.hash_broker = self.hash_broker
+			self.hash_broker.expected += 1
+		self.total += 1
+		return bound
+
+	def add_results(self, verified):
+		with self._lock:
+			self.results += verified
+			self.result_count += len(verified)
+			self.completed += 1
+			return self.result_count
+
+	def cancel(self):
+		self.abort_event.set()
+
+	def is_canceled(self):
+		return self.abort_event.is_set()
+
+	def get_remaining(self):
+		if self.deadline is None: return None
+		return max(self.deadline - time.time(), 0)
+
+	def is_expired(self):
+		return self.deadline is not None and time.time() > self.deadline
+
+	def is_active(self):
+		return not self.is_canceled() and not self.is_expired()
 
 # ScrapeCore class
 class ScrapeCore(object):
 	PB = False
-	abort_event = Event()
-	results = []
-	active_scrapers = {}
-	result_count = 0
 	
 	def __init__(self, supported_scrapers, load_list=None, ignore_list=[]):
 		# Verify each scraper is enabled removing ignored
 		# We generate the list of active scrapers
-		# Each scraper is given the abort event. This can be respected in the individual scraper.
+		# Each search binds the active scrapers to its own SearchSession, which gives them the abort event and deadline.
+		# The session is passed along explicitly rather than stored on the instance, so searches can run concurrently.
+		# The abort event can be respected in the individual scraper.
 		# However if ignored, the thread will be allowed to continue and its results ignored
+		self.active_scrapers = {}
 		for s in supported_scrapers:
-			s.abort_event = self.abort_event
 			if s.service in ignore_list: continue
 			if type(load_list) is list and s.service not in load_list: continue
 			if kodi.get_setting(s.service +'_enable', addon_id=ADDON_ID) == 'true' and s.valid:
@@ -71,54 +138,138 @@ class ScrapeCore(object):
 			pass
 		return c
 
-	def handle_abort(self):
+	def handle_abort(self, session):
 		# Wait for the format results to complete or an explicit abort event
 		while True:
-			if self.is_canceled() or self.abort_event.isSet():
-				self.abort_event.set()
+			if self.is_canceled() or session.is_canceled():
+				session.cancel()
 				break
 			kodi.sleep(50)
-	def process_results(self, results):
-		if self.abort_event.is_set(): 
+
+	def join_pool(self, pool, session):
+		# Wait for the pool to finish or the deadline to pass, whichever comes first
+		finished = Event()
+		def join():
+			pool.joinAll()
+			finished.set()
+		Thread(target=join).start()
+		return finished.wait(session.get_remaining())
+
+	def process_results(self, session, results):
+		if session.is_canceled(): 
 			self.PB.update_subheading('Aborting', 'Aborting...')
 			return
+		if session.is_expired(): return
 		name, verified = results
 		verified = {v['raw_url']:v for v in verified}.values()
-		self.results += verified
 		search_count = len(verified)
-		self.result_count += search_count
-		self.PB.next("Total Results: [COLOR green]%s[/COLOR]" % self.result_count, "Found [COLOR green]%s[/COLOR] links from [COLOR orange]%s[/COLOR]" % (search_count, name))
+		result_count = session.add_results(verified)
+		self.PB.next("Total Results: [COLOR green]%s[/COLOR]" % result_count, "Found [COLOR green]%s[/COLOR] links from [COLOR orange]%s[/COLOR]" % (search_count, name))
+
+	regex_host = re.compile("\.\S+$")
+	def format_result(self, r):
+		service = r['service'].upper()
+		host = format_color(self.regex_host.sub("", r['host'].upper()), 'darkred')
+		#if r['cached']: host += " " + format_color('*', 'yellow')
+		attribs = [service, host]
+		if r['size']: r['size_sort'] = int(r['size'])
+		else: r['size_sort'] = 0
+		if r['size']: attribs += [format_color(format_size(r['size']), 'blue')]
+		if r['title']: attribs += [r['title']]
+		r['display'] = ' | '.join(attribs)
+		return r
 
-	def format_results(self, results):
-		if self.abort_event.is_set():
+	"""
+	prepare_results is the single pass post-processing pipeline:
+	each result is deduplicated by raw_url (the last one found is kept, as before) and formated in the same loop,
+	then the unique results are sorted once by quality and size. It is O(n log n) overall, see scrapecore.benchmark
+	"""
+	def prepare_results(self, results):
+		seen = set()
+		unique = []
+		for r in reversed(results):
+			if r['raw_url'] in seen: continue
+			seen.add(r['raw_url'])
+			unique.append(self.format_result(r))
+		unique.reverse()
+		unique.sort(reverse=True, key=lambda k: (k['quality'], k['size_sort']))
+		return unique
+
+	def format_results(self, session, results):
+		if session.is_canceled():
 			self.PB.close()
 			return []
-		self.PB.update_subheading('Processing Results', '')
-		self.PB.update_subheading('Processing Results', 'Formating Results...')
-		regex_host = re.compile("\.\S+$")
-		for r in results:
-			service = r['service'].upper()
-			host = format_color(regex_host.sub("", r['host'].upper()), 'darkred')
-			#if r['cached']: host += " " + format_color('*', 'yellow')
-			attribs = [service, host]
-			if r['size']: r['size_sort'] = int(r['size'])
-			else: r['size_sort'] = 0
-			if r['size']: attribs += [format_color(format_size(r['size']), 'blue')]
-			if r['title']: attribs += [r['title']]
-			display = ' | '.join(attribs)
-			self.results[results.index(r)]['display'] = display
-			
-		kodi.sleep(250)
-		self.PB.update_subheading('Processing Results', 'Removing Duplicates...')
-		kodi.sleep(250)
-		self.results = {v['raw_url']:v for v in results}.values()
-		self.PB.update_subheading('Processing Results', 'Sorting...')
-		kodi.sleep(250)
-		results.sort(reverse=True, key=lambda k: (k['quality'], k['size_sort']))
+		self.PB.update_subheading('Processing Results', 'Formating, Removing Duplicates and Sorting...')
+		results = session.results = self.prepare_results(results)
 		self.PB.close()
-		self.abort_event.set()
+		session.cancel()
 		return results
 
+	def get_search_args(self, media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None):
+		if media == 'movie':
+			return 'search_movies', {"title": title, "year": year, "trakt_id": trakt_id, "imdb_id": imdb_id, "tmdb_id": tmdb_id}
+		else:
+			return 'search_shows', {"title": title, "episode_title": episode_title, "season": season, "episode": episode, "year": year, "trakt_id": trakt_id, "imdb_id": imdb_id, "tvdb_id": tvdb_id}
+
+	"""
+	Scrapers are queued fastest, highest yield first according to the stored statistics.
+	Scrapers without statistics yet are queued first so they get measured.
+	Each scraper is bound to the session and its search function wrapped to time it,
+	count its requests, throttled and failed requests, errors and the results at each quality.
+	Every scraper is bound before the first is queued, so the session's HashBroker expects all torrent scrapers
+	before any of them can submit its hashes.
+	"""
+	def queue_search(self, pool, session, method, args, callback):
+		ranking = scrapecore.get_scraper_ranking()
+		rank = lambda service: ranking.index(service) if service in ranking else -1
+		bound = []
+		for service in sorted(self.active_scrapers.keys(), key=rank):
+			scraper = self.active_scrapers[service]
+			if method in dir(scraper):
+				bound.append(session.bind(scraper))
+		for scraper in bound:
+			pool.queueTask(self.measure(session, scraper, method), args=args, taskCallback=callback)
+
+	def measure(self, session, scraper, method):
+		func = getattr(scraper, method)
+		stats = session.stats[scraper.service] = {"start": time.time(), "duration": 0, "requests": 0, "throttled": 0, "failed": 0, "errors": 0, "timeouts": 0, "results": {}, "started": False, "finished": False}
+		def run(args):
+			stats['start'] = time.time()
+			stats['started'] = True
+			try:
+				response = func(args)
+				for r in response[1] if response else []:
+					stats['results'][r['quality']] = stats['results'].get(r['quality'], 0) + 1
+				return response
+			except ScrapeCoreTimeout:
+				stats['timeouts'] = 1
+				raise
+			except:
+				stats['errors'] = 1
+				raise
+			finally:
+				stats['duration'] = time.time() - stats['start']
+				stats['requests'] = scraper.request_count
+				stats['throttled'] = scraper.throttled_count
+				stats['failed'] = scraper.failed_count
+				stats['finished'] = True
+		return run
+
+	def save_stats(self, session):
+		# Scrapers still running when the search ends are recorded as timed out.
+		# Scrapers still waiting in the pool never ran, they are left out rather than ranked last for it
+		started = {}
+		for service, stats in session.stats.iteritems():
+			if not stats['started']: continue
+			if not stats['finished']:
+				stats['duration'] = time.time() - stats['start']
+				stats['timeouts'] = 1
+			started[service] = stats
+		try:
+			scrapecore.record_scraper_stats(started)
+		except Exception, e:
+			kodi.log(e)
+
 	"""
 	The main search routine search
 	Initiates a threadpool of THREAD_POOL_SIZE with timeout THREAD_TIMEOUT
@@ -136,76 +287,155 @@ class ScrapeCore(object):
 	"""
 
 	def search(self, media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None):
+		session = SearchSession()
 		self.PB = ProgressBar()
 		pool = ThreadPool(THREAD_POOL_SIZE, THREAD_TIMEOUT)
-		pool.__abort_event = self.abort_event
-		monitor = Thread(target=self.handle_abort)
+		pool.__abort_event = session.abort_event
+		monitor = Thread(target=self.handle_abort, args=(session,))
 		monitor.start()
+		method, args = self.get_search_args(media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id)
 		if media == 'movie':
 			self.PB.new('Searching for Movie Sources', self.count)
-			args = {"title": title, "year": year, "trakt_id": trakt_id, "imdb_id": imdb_id, "tmdb_id": tmdb_id}
-			for service, scraper in self.active_scrapers.iteritems():
-				if 'search_movies' in dir(scraper):
-					pool.queueTask(scraper.search_movies, args=args, taskCallback=self.process_results)
 		else:
 			self.PB.new('Searching for Episode Sources', self.count)
-			args = {"title": title, "episode_title": episode_title, "season": season, "episode": episode, "year": year, "trakt_id": trakt_id, "imdb_id": imdb_id, "tvdb_id": tvdb_id}
-			for service, scraper in self.active_scrapers.iteritems():
-				if 'search_shows' in dir(scraper):
-					pool.queueTask(scraper.search_shows, args=args, taskCallback=self.process_results)
-				
-		pool.joinAll()
-		if len(self.results) == 0:
+		self.queue_search(pool, session, method, args, lambda results: self.process_results(session, results))
+		if not self.join_pool(pool, session):
+			kodi.log('Search deadline reached, returning %s results' % session.result_count)
+		self.save_stats(session)
+		if len(session.results) == 0:
 			self.PB.close()
-			self.abort_event.set()
+			session.cancel()
 			return []
 		
-		return self.format_results(self.results)
-	
-	
-supported_scrapers = []
-# First get a list of scraper resource modules
-kodi.set_property("new_scraper", "false", 'script.module.scrapecore')
-available = scrapecore.get_installed_resources()
-ignore_list = ['__init__.py', '__all__.py', 'common.py', 'example.py']
-# Load scrapers from each module serially
-
-for mod in available:
-	path = kodi.vfs.join(mod['path'], 'scrapers')
-	sys.path.append(path)
-	# Directory list the resource module
-	for filename in sorted(os.listdir(path)):
-		# Ignore these
-		test = filename.lower() 
-		if test not in ignore_list and test.endswith('.py'):
-			name = filename[0:len(filename)-3]
-			scraper_path = kodi.vfs.join(path, filename)
-			# Now read the scraper code and execute it
-			code = kodi.vfs.read_file(scraper_path)
-			if code:
+		results = self.format_results(session, session.results)
+		self.prefetch(results)
+		return results
+	
+	def prefetch(self, results):
+		if prefetch.prefetch_enabled():
+			# Resolve the top sources in the background while the user chooses, only search has the final sorted list so iter_search does not
+			prefetch.prefetcher.prefetch(results, self.active_scrapers.__getitem__)
+	
+	refreshing = set()
+	refresh_lock = Lock()
+	def get_result_key(self, media, title, season=None, episode=None, year=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None):
+		return cache.search_key({"media": media, "title": title, "season": season, "episode": episode, "year": year, "trakt_id": trakt_id, "imdb_id": imdb_id, "tmdb_id": tmdb_id, "tvdb_id": tvdb_id, "scrapers": sorted(self.active_scrapers.keys())})
+	
+	# The refresh runs its own iter_search, and so its own SearchSession, on a daemon thread that does not hold up shutdown
+	def refresh_results(self, cache_key, cached, created, args):
+		with self.refresh_lock:
+			if cache_key in self.refreshing: return
+			self.refreshing.add(cache_key)
+		def refresh():
+			try:
+				found = list(self.iter_search(*args))
+				# Sources found now come last so their details replace the cached ones
+				cache.set_search_results(cache_key, self.prepare_results(cached + found), created)
+			except Exception, e:
+				kodi.log(e)
+			finally:
+				with self.refresh_lock:
+					self.refreshing.discard(cache_key)
+		t = Thread(target=refresh)
+		t.daemon = True
+		t.start()
+	
+	"""
+	cached_search serves a search from the result cache, see scrapecore.cache
+	The key covers the media type, title, year, season, episode, external ids and the active scrapers.
+	Results refreshed longer than the soft ttl ago are returned at once while a background iter_search merges in newly found sources.
+	A miss, or results whose full search is older than the hard ttl, runs the full search and stores its results.
+	"""
+	
+	def cached_search(self, media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None):
+		args = (media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id)
+		if not cache.result_cache_enabled(): return self.search(*args)
+		cache_key = self.get_result_key(media, title, season, episode, year, trakt_id, imdb_id, tmdb_id, tvdb_id)
+		cached = cache.get_search_results(cache_key)
+		if cached is None:
+			results = self.search(*args)
+			if results: cache.set_search_results(cache_key, results)
+			return results
+		created, refreshed, results = cached
+		if time.time() - refreshed > cache.get_result_ttls()[0]:
+			self.refresh_results(cache_key, results, created, args)
+		self.prefetch(results)
+		return results
+	
+	"""
+	iter_search is the streaming counterpart of search
+	Sources are yielded as soon as each scraper's results arrive rather than after every scraper has finished.
+	Each media object is formated and deduplicated by raw_url across scrapers before being yielded.
+	
+	Early stopping:
+		stop_after=N stops the search once N sources have been yielded
+		combined with min_quality, only sources of at least that QUALITY are counted
+		Example: iter_search('movie', title, year=year, min_quality=QUALITY.HD1080, stop_after=5)
+	
+	Leaving the loop early (break) also stops the search. In both cases the session is canceled
+	and any late results are ignored.
+	"""
+	
+	def iter_search(self, media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None, min_quality=None, stop_after=None):
+		session = SearchSession()
+		queue = Queue.Queue()
+		def enqueue(results):
+			if not session.is_active(): return
+			queue.put(results)
+		def join(pool):
+			pool.joinAll()
+			queue.put(None)
+		
+		pool = ThreadPool(THREAD_POOL_SIZE, THREAD_TIMEOUT)
+		pool.__abort_event = session.abort_event
+		method, args = self.get_search_args(media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id)
+		self.queue_search(pool, session, method, args, enqueue)
+		Thread(target=join, args=(pool,)).start()
+		seen = set()
+		found = 0
+		try:
+			while True:
 				try:
-					exec code
-				except ScrapeCoreException as e:
-					kodi.log(e)
-					kodi.log("Invalid scraper: %s" % name)
-					continue
-				# Scrape checks out, now access obtain an instance of the main class and store it in the list of _active_scrapers
-				classname = name+'Scraper'
-				scraper = __import__('', globals(), locals(), [classname], -1)
-				klass = getattr(scraper, classname)
-				scraper = klass()
-				# Install the scraper if it has not already been installed
-				scrapecore.install_scraper(scraper)
-				supported_scrapers.append(scraper)
-# Re-write the scrapers settings xml if scraper count has changed
-if kodi.get_property("new_scraper", 'script.module.scrapecore'):
-	scrapecore.write_settings_file()
-	kodi.set_property("new_scraper", "false", 'script.module.scrapecore')
+					results = queue.get(timeout=session.get_remaining())
+				except Queue.Empty:
+					break
+				if results is None: break
+				name, verified = results
+				unique = []
+				for v in verified:
+					# Checked per item so duplicates within one scraper's results are dropped too
+					if v['raw_url'] in seen: continue
+					seen.add(v['raw_url'])
+					unique.append(v)
+				session.add_results(unique)
+				for v in unique:
+					yield self.format_result(v)
+					if min_quality is None or v['quality'] >= min_quality:
+						found += 1
+					if stop_after and found >= stop_after: return
+		finally:
+			session.cancel()
+			self.save_stats(session)
+	
+	
+# Get a list of scraper resource modules and load the scraper manifest
+# Scraper modules are only executed when new, changed or first used. See scrapecore.loader
+loader = ScraperLoader(globals())
+supported_scrapers = loader.load(scrapecore.get_installed_resources(), ScrapeCoreException, scrapecore.get_registered_services())
+# Install the scrapers that are new, changed or missing from core.db in one transaction, the settings xml is rewritten only if it changed
+scrapecore.install_scrapers(loader.installed)
 
 # This is the publicly called search function
 def search(media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None, load_list=None, ignore_list=[]):
+	cache.start_background_prune()
+	scrapers = ScrapeCore(supported_scrapers, load_list, ignore_list)
+	return scrapers.cached_search(media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id)
+
+# Streaming version of search, yields formated sources as each scraper finishes
+def iter_search(media, title, season=None, episode=None, year=None, episode_title=None, trakt_id=None, imdb_id=None, tmdb_id=None, tvdb_id=None, load_list=None, ignore_list=[], min_quality=None, stop_after=None):
+	cache.start_background_prune()
 	scrapers = ScrapeCore(supported_scrapers, load_list, ignore_list)
-	return scrapers.search(media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id)
+	return scrapers.iter_search(media, title, season, episode, year, episode_title, trakt_id, imdb_id, tmdb_id, tvdb_id, min_quality, stop_after)
 
 def get_scraper_by_name(service):
 	return ScrapeCore(supported_scrapers).active_scrapers[service]
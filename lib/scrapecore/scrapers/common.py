@@ -21,13 +21,13 @@ import sys
 SCRAPER_DIR = os.path.dirname(os.path.abspath(__file__))
 lib_path = SCRAPER_DIR.replace('scrapers', '')
 sys.path.append(lib_path)
-import hashlib
 import json
 import time
-import zlib
 import urllib
 import random
 import requests
+import threading
+from collections import deque, OrderedDict
 
 from urlparse import urljoin, urlparse
 from commoncore import kodi
@@ -37,13 +37,142 @@ from commoncore import premiumize
 from commoncore import dom_parser
 from commoncore.BeautifulSoup import BeautifulSoup
 from commoncore.threadpool import ThreadPool
+from scrapecore import cache
+from scrapecore.cache import response_cache, memory_cache, canonical_key
+from scrapecore.sessions import SessionPool, SingleFlight, FlightTimeout
+from scrapecore.ratelimit import RateLimiter, parse_retry_after, get_backoff
+from scrapecore.executor import SharedExecutor
+from scrapecore import scrapecore
+from scrapecore import debrid
+from scrapecore import dom
+from scrapecore.quality import QUALITY
+from scrapecore.prefetch import prefetcher
 vfs = kodi.vfs
 	
 ADDON_ID = 'script.module.scrapecore'
 CACHE_PATH = vfs.join("special://home", "userdata/addon_data/script.module.scrapecore/cache")
 if not vfs.exists(CACHE_PATH): vfs.mkdir(CACHE_PATH)
+THREAD_POOL_SIZE = 20
 VERIFY_POOLS_SIZE = 15
-QUALITY = enum(LOCAL=9, HD1080=8, HD720=7, HD=6, HIGH=5, SD480=4, UNKNOWN=3, LOW=2, POOR=1)
+# With execution_mode set to shared, verify work of every scraper runs on one set of SHARED_POOL_SIZE workers
+SHARED_POOL_SIZE = VERIFY_POOLS_SIZE * 2
+verify_executor = SharedExecutor(SHARED_POOL_SIZE)
+# One session per service, each scraper runs one search thread and up to VERIFY_POOLS_SIZE verify threads,
+# or up to SHARED_POOL_SIZE in shared mode, all of them kept alive to the same host
+sessions = SessionPool(THREAD_POOL_SIZE, max(VERIFY_POOLS_SIZE, SHARED_POOL_SIZE) + 1)
+# Cache keys of stale responses being revalidated, one background refresh per key
+revalidating = set()
+revalidate_lock = threading.Lock()
+# Identical requests in flight at the same time are sent once, see BaseScraper.request
+flights = SingleFlight()
+# Request headers that can change the response, the others are left out of the flight key
+FLIGHT_HEADERS = ['Accept', 'Accept-Language', 'Authorization', 'Cookie', 'Content-Type', 'Range']
+# Requests are spaced per domain by token buckets, see BaseScraper.send and BaseScraper.fetch
+limiter = RateLimiter()
+# Guards the per scraper counters, which the scraper's search and verify threads all increment
+counter_lock = threading.Lock()
+# Responses that mean the server is throttling us, retried after Retry-After or a jittered backoff
+THROTTLE_STATUS = [429, 503]
+CLOUDFLARE_TITLE = '<title>Attention Required! | Cloudflare</title>'
+
+class ScrapeCoreTimeout(Exception):
+	pass
+
+"""
+	LatencyTracker
+	Keeps the most recent request durations of each service.
+	get_timeout derives a per request timeout from them: LATENCY_FACTOR times the LATENCY_PERCENTILE duration,
+	kept between MIN_TIMEOUT and the scraper's own timeout. Until LATENCY_MIN_SAMPLES are recorded the scraper's timeout is used.
+"""
+LATENCY_SAMPLES = 50
+LATENCY_MIN_SAMPLES = 5
+LATENCY_PERCENTILE = 90
+LATENCY_FACTOR = 2
+MIN_TIMEOUT = 2
+
+class LatencyTracker(object):
+	def __init__(self):
+		self._samples = {}
+		self._lock = threading.Lock()
+
+	def record(self, key, elapsed):
+		with self._lock:
+			if key not in self._samples:
+				self._samples[key] = deque(maxlen=LATENCY_SAMPLES)
+			self._samples[key].append(elapsed)
+
+	def percentile(self, key, p):
+		with self._lock:
+			samples = sorted(self._samples.get(key, []))
+		if not samples: return None
+		return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+	def get_timeout(self, key, default):
+		with self._lock:
+			count = len(self._samples.get(key, []))
+		if count < LATENCY_MIN_SAMPLES: return default
+		return min(max(self.percentile(key, LATENCY_PERCENTILE) * LATENCY_FACTOR, MIN_TIMEOUT), default)
+
+latency = LatencyTracker()
+
+"""
+	ReleaseClassifier
+	Extracts quality, container, HEVC and hardcoded subtitle flags from a release name in one pass of a single compiled regex.
+	The precedence of the individual regex definitions in BaseScraper is kept:
+		quality		1080p, 720p, 480p, 320p/240p
+		extension	mkv, mp4, avi, mpg, flv
+		hc			case sensitive
+	Release names repeat heavily across scrapers so results are memoized in a bounded lru of CLASSIFIER_CACHE_SIZE entries.
+"""
+CLASSIFIER_CACHE_SIZE = 4096
+
+class ReleaseClassifier(object):
+	regex = re.compile(
+		'(?P<hd1080>1080p)|(?P<hd720>720p)|(?P<sd>480p)|(?P<low>320p|240p)'
+		'|(?P<x265>x265)|(?P<hevc>hevc(?=[-_\s\.]))|(?P<hc>hc(?=[-_\s\.]))'
+		'|(?P<ext>\.(?:mkv|mp4|avi|flv)$)|(?P<mpg>\.mpg|mpeg|vob$)',
+		re.IGNORECASE
+	)
+	qualities = [('hd1080', QUALITY.HD1080), ('hd720', QUALITY.HD720), ('sd', QUALITY.SD480), ('low', QUALITY.LOW)]
+
+	def __init__(self, size=CLASSIFIER_CACHE_SIZE):
+		self.size = size
+		self._cache = OrderedDict()
+		self._lock = threading.Lock()
+
+	def _classify(self, string):
+		found = {}
+		extension = False
+		for m in self.regex.finditer(string):
+			group = m.lastgroup
+			if group == 'hc' and m.group() != 'HC': continue
+			if group == 'ext': extension = m.group()[1:].lower()
+			found[group] = True
+		quality = None
+		for group, q in self.qualities:
+			if group in found:
+				quality = q
+				break
+		if extension == 'flv' and 'mpg' in found: extension = 'mpg'
+		elif not extension and 'mpg' in found: extension = 'mpg'
+		x265 = 1 if 'x265' in found or 'hevc' in found else 0
+		hc = 1 if 'hc' in found else 0
+		return quality, extension, x265, hc
+
+	""" Returns (quality or None, extension or False, x265 1|0, hc 1|0) """
+	def classify(self, string):
+		with self._lock:
+			if string in self._cache:
+				result = self._cache.pop(string)
+				self._cache[string] = result
+				return result
+		result = self._classify(string)
+		with self._lock:
+			self._cache[string] = result
+			if len(self._cache) > self.size: self._cache.popitem(last=False)
+		return result
+
+classifier = ReleaseClassifier()
 
 
 """
@@ -52,17 +181,38 @@ QUALITY = enum(LOCAL=9, HD1080=8, HD720=7, HD=6, HIGH=5, SD480=4, UNKNOWN=3, LOW
 """
 
 class BaseScraper():
-	session = requests.Session()
 	abort_event = False
+	deadline = None
 	accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
 	timeout = 5
 	torrent = False
+	prefetch = False
+	rate_limit = 5
+	rate_burst = 10
+	max_retries = 2
 	verified_results = []
 	search_count = 0
 	result_count = 0
+	request_count = 0
+	throttled_count = 0
+	failed_count = 0
 	valid = True
 	domains = []
 	
+	@property
+	def session(self):
+		return sessions.get(self.service)
+	
+	def get_session_stats(self):
+		stats = sessions.stats(self.service).get(self.service, {"opened": 0, "reused": 0, "requests": 0})
+		stats['coalesced'] = flights.stats(self.service)['coalesced']
+		stats.update(limiter.stats(self.service))
+		return stats
+	
+	def increment(self, counter):
+		with counter_lock:
+			setattr(self, counter, getattr(self, counter) + 1)
+	
 	def get_setting(self, k):
 		return kodi.get_setting(self.service + '_' + k, 'script.module.scrapecore')
 	
@@ -107,29 +257,19 @@ class BaseScraper():
 	def get_file_from_url(self, url):
 		return os.path.basename(url)
 	
-	""" See regex definitions above """
+	""" See regex definitions above, these use the single pass ReleaseClassifier """
 	def test_quality(self, string, default=QUALITY.UNKNOWN):
-		if self.regex['hd1080'].search(string): return QUALITY.HD1080
-		if self.regex['hd720'].search(string): return QUALITY.HD720
-		if self.regex['sd'].search(string): return QUALITY.SD480
-		if self.regex['low'].search(string): return QUALITY.LOW
-		return default
+		quality = classifier.classify(string)[0]
+		return default if quality is None else quality
 
 	def get_file_type(self, string):
-		if self.regex['mkv'].search(string): return 'mkv'
-		if self.regex['mp4'].search(string): return 'mp4'
-		if self.regex['avi'].search(string): return 'avi'
-		if self.regex['mpg'].search(string): return 'mpg'
-		if self.regex['flv'].search(string): return 'flv'
-		return False
+		return classifier.classify(string)[1]
 	
 	def is_hc(self, string):
-		if self.regex['hc'].search(string): return 1
-		return 0
+		return classifier.classify(string)[3]
 	
 	def is_hvec(self, string):
-		if self.regex['hvec'].search(string): return 1
-		return 0
+		return classifier.classify(string)[2]
 	
 	def get_domain_from_url(self, url):
 		parsed_uri = urlparse( url )
@@ -144,8 +284,9 @@ class BaseScraper():
 	def format_move_query(self, title, year):
 		return "%s %s" % (title, year)
 	
-	def parse_dom(self, html, name=u"", attrs={}, ret=False):
-		return dom_parser.parse_dom(html, name, attrs, ret)
+	""" Same results as commoncore.dom_parser.parse_dom from a single streaming scan, limit stops after that many matches. See scrapecore.dom """
+	def parse_dom(self, html, name=u"", attrs={}, ret=False, limit=None):
+		return dom.parse_dom(html, name, attrs, ret, limit)
 	
 	def decode_entities(self, s):
 		try:
@@ -179,12 +320,39 @@ class BaseScraper():
 	def resolve_url(self, raw_url):
 		return raw_url
 	
+	""" Resolves raw_url without any dialogs, returning (resolved_url, playback properties). Used to prefetch sources """
+	def resolve_source(self, raw_url):
+		return self.resolve_url(raw_url), {}
+	
+	""" resolve_url for scrapers implementing resolve_source: a prefetched source is used as is, otherwise it is resolved behind the busy dialog """
+	def resolve_playback(self, raw_url):
+		resolved = prefetcher.cache.get(raw_url)
+		if resolved is None:
+			# Waiting on a prefetch still in flight can take as long as resolving, so it is behind the busy dialog too
+			kodi.open_busy_dialog()
+			try:
+				resolved = prefetcher.get(raw_url)
+				if resolved is None: resolved = self.resolve_source(raw_url)
+			except Exception, e:
+				kodi.log(e)
+				resolved = ('', {})
+			kodi.close_busy_dialog()
+		resolved_url, properties = resolved
+		for k, v in properties.iteritems():
+			kodi.set_property(k, v)
+		return resolved_url
+	
 	def get_domains(self):
 		self.domains = []
 	
+	def get_verify_pool(self):
+		if kodi.get_setting('execution_mode', ADDON_ID) == 'shared':
+			return verify_executor.group()
+		return ThreadPool(VERIFY_POOLS_SIZE)
+	
 	def verify_results(self, processor, results):
 		self.get_domains()
-		pool = ThreadPool(VERIFY_POOLS_SIZE)
+		pool = self.get_verify_pool()
 		for result in results:
 			if isinstance(result, list):
 				for r in result:
@@ -223,29 +391,84 @@ class BaseScraper():
 		
 		return user_agent
 	
-	def get_cached_response(self, url, cache_limit):
-		cache_hash = hashlib.md5(str(url)).hexdigest()
-		cache_file = vfs.join(CACHE_PATH, cache_hash)
-		if vfs.exists(cache_file):
-			temp = vfs.read_file(cache_file + '.ts')
-			if (time.time() - vfs.get_stat(cache_file).st_ctime()) / 3600 > int(temp):
-				vfs.rm(cache_file, quiet=True)
-				vfs.rm(cache_file + '.ts', quiet=True)
-				return False
-			else:
-				html = zlib.decompress(vfs.read_file(cache_file)).decode('utf-8')
-				kodi.log('Returning cached request')
-				return html
-		return False	
-			
+	"""
+		Cached responses are looked up in memory first, then in the sqlite store. See scrapecore.cache
+		An expired response is still returned at once and revalidated in the background. The refresh sends the stored
+		ETag and Last-Modified back, so an unchanged page answers 304 and only its expiry is renewed.
+	"""
+	def get_cached_response(self, url, cache_limit, params=None, headers=None):
+		cache_key = canonical_key(url, params)
+		html = memory_cache.get(cache_key)
+		if html is not None: return html
+		cached = response_cache.get(cache_key, stale=True)
+		if cached is None: return False
+		html, content_type, expires, validators = cached
+		if expires > time.time():
+			memory_cache.set(cache_key, html, expires)
+			kodi.log('Returning cached request')
+		else:
+			kodi.log('Returning stale cached request')
+			self.revalidate(url, cache_limit, params, headers, validators)
+		return html
 
-	def cache_response(self, url, html, cache_limit):
+	def cache_response(self, url, html, cache_limit, params=None, content_type=None, etag=None, last_modified=None):
 		if html and cache_limit:
-			cache_hash = hashlib.md5(str(url)).hexdigest()
-			cache_file = vfs.join(CACHE_PATH, cache_hash)
-			output = html.encode('utf-8') if type(html) == unicode else html
-			vfs.write_file(cache_file, zlib.compress(output))
-			vfs.write_file(cache_file+'.ts', str(cache_limit))
+			cache_key = canonical_key(url, params)
+			expires = response_cache.set(cache_key, url, html, cache_limit, content_type, etag, last_modified)
+			memory_cache.set(cache_key, html, expires)
+			for return_type in cache.PARSED_TYPES:
+				memory_cache.delete(cache.parsed_key(cache_key, return_type))
+	
+	""" The parsed form of a fresh cached response, so a hit with the same return_type skips parsing. None on a miss """
+	def get_cached_parsed(self, url, return_type, params=None):
+		if return_type not in cache.PARSED_TYPES or not cache.parsed_cache_enabled(): return None
+		cache_key = canonical_key(url, params)
+		key = cache.parsed_key(cache_key, return_type)
+		data = memory_cache.get(key)
+		if data is None:
+			cached = response_cache.get_parsed(cache_key, return_type)
+			if cached is None: return None
+			data, expires = cached
+			memory_cache.set(key, data, expires, len(data))
+		try:
+			return cache.load_parsed(data)
+		except Exception, e:
+			kodi.log(e)
+			return None
+	
+	def cache_parsed(self, url, return_type, parsed, params=None):
+		if return_type not in cache.PARSED_TYPES or not cache.parsed_cache_enabled(): return
+		try:
+			response_cache.set_parsed(canonical_key(url, params), return_type, cache.dump_parsed(parsed))
+		except Exception, e:
+			kodi.log(e)
+	
+	def revalidate(self, url, cache_limit, params, headers, validators):
+		cache_key = canonical_key(url, params)
+		with revalidate_lock:
+			if cache_key in revalidating: return
+			revalidating.add(cache_key)
+		headers = dict(headers or {})
+		etag, last_modified = validators
+		if etag: headers['If-None-Match'] = etag
+		if last_modified: headers['If-Modified-Since'] = last_modified
+		def refresh():
+			try:
+				response = self.send(url, params, headers, self.timeout)
+				if response.status_code == 304:
+					kodi.log('Cached request not modified')
+					response_cache.touch(cache_key, cache_limit)
+				elif response.status_code == requests.codes.ok:
+					response.encoding = 'utf-8'
+					self.cache_response(url, response.text, cache_limit, params, response.headers.get('Content-Type'), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+			except Exception, e:
+				kodi.log(e)
+			finally:
+				with revalidate_lock:
+					revalidating.discard(cache_key)
+		t = threading.Thread(target=refresh)
+		t.daemon = True
+		t.start()
 	
 	def process_response(self, response, return_type='text'):
 		if return_type == 'json':
@@ -269,16 +492,34 @@ class BaseScraper():
 		if 'raw_url' in obj: media['raw_url'] = obj['raw_url']
 		if 'host_icon' in obj: media['host_icon'] = obj['host_icon']
 		if 'size' in obj: media['size'] = obj['size']
+		quality, media['extension'], media['x265'], media['hc'] = classifier.classify(media['title'])
 		if 'quality' in obj: media['quality'] = obj['quality']
-		else : media['quality'] = self.test_quality(media['title'])
+		else : media['quality'] = QUALITY.UNKNOWN if quality is None else quality
 		if media['quality'] == QUALITY.UNKNOWN:
 			media['quality'] = self.test_quality(media['raw_url'])
-		media['extension'] = self.get_file_type(media['title'])
-		media['x265'] = self.is_hvec(media['title'])
-		media['hc'] = self.is_hc(media['title'])
 		media['icon'] = "definition/%s.png" % QUALITY.r_map[media['quality']].lower() 
 		return media
 	
+	def make_media_objects(self, objs):
+		return [self.make_media_object(obj) for obj in objs]
+	
+	"""
+		Without an explicit timeout, the timeout is derived from the service's recent latency. See LatencyTracker
+		During a search the timeout is also capped to the time left before the search deadline,
+		once the deadline has passed or the search is aborted ScrapeCoreTimeout is raised so the scraper thread unwinds
+		instead of making further requests.
+	"""
+	def get_request_timeout(self, timeout=None):
+		if self.abort_event and self.abort_event.is_set():
+			raise ScrapeCoreTimeout('Search aborted: %s' % self.service)
+		if timeout is None:
+			timeout = latency.get_timeout(self.service, self.timeout)
+		if self.deadline:
+			remaining = self.deadline - time.time()
+			if remaining <= 0: raise ScrapeCoreTimeout('Search deadline exceeded: %s' % self.service)
+			timeout = min(timeout, remaining)
+		return timeout
+	
 	def build_url(self, uri, query, append_base):
 		if query:
 			uri += "?" + urllib.urlencode(query)
@@ -289,6 +530,27 @@ class BaseScraper():
 			url = uri
 		return url	
 	
+	"""
+		Each request first takes a token from its domain's bucket, rate_limit requests per second with bursts of rate_burst.
+		The wait counts against the search deadline, ScrapeCoreTimeout is raised when it would end after it.
+		Set rate_limit = 0 on a scraper class to send without limit.
+	"""
+	def send(self, url, params, headers, timeout):
+		wait = limiter.acquire(url, self.rate_limit, self.rate_burst, self.get_remaining(), self.service)
+		if wait is None: raise ScrapeCoreTimeout('Rate limited past the search deadline: %s' % self.service)
+		if wait:
+			self.sleep(wait)
+			timeout = self.get_request_timeout(timeout)
+		self.increment('request_count')
+		start = time.time()
+		try:
+			if params:
+				return self.session.post(url, data=json.dumps(params), headers=headers, timeout=timeout, verify=False)
+			else:
+				return self.session.get(url, headers=headers, timeout=timeout, verify=False)
+		finally:
+			latency.record(self.service, time.time() - start)
+	
 	def request(self, uri, query=None, params=None, headers=None, timeout=None, cache_limit=0, return_type="text", append_base=True):
 
 		if headers:
@@ -308,39 +570,99 @@ class BaseScraper():
 		url = self.build_url(uri, query, append_base)
 		if url is None: return ''
 
-		if timeout is None:
-			timeout = self.timeout	
-		
 		if cache_limit > 0:
-			if params is None:
-				cache_url = url
-			else:
-				cache_url = url + str(params)
-
-			cached_response = self.get_cached_response(cache_url, cache_limit)
+			parsed = self.get_cached_parsed(url, return_type, params)
+			if parsed is not None: return parsed
+			cached_response = self.get_cached_response(url, cache_limit, params, headers)
 			if cached_response:
-				return self.process_response(cached_response, return_type)
+				parsed = self.process_response(cached_response, return_type)
+				self.cache_parsed(url, return_type, parsed, params)
+				return parsed
 		
-		if params:
-			response = self.session.post(url, data=json.dumps(params), headers=headers, timeout=timeout, verify=False)
-		else:
-			response = self.session.get(url, headers=headers, timeout=timeout, verify=False)	
-		response.encoding = 'utf-8'
-		self.last_response = response
-		if response.status_code == requests.codes.ok:
-			html = response.text
-		elif response.status_code == 403 and '<title>Attention Required! | Cloudflare</title>' in response.text:
-			kodi.log('protected by cloudflare')
-			response.raise_for_status()		
+		timeout = self.get_request_timeout(timeout)
+		try:
+			html, self.last_response = flights.do(self.get_flight_key(url, params, headers), lambda: self.fetch(url, params, headers, timeout, cache_limit), self.service, self.get_remaining())
+		except FlightTimeout:
+			raise ScrapeCoreTimeout('Search deadline exceeded waiting for a shared request: %s' % self.service)
+		parsed = self.process_response(html, return_type)
+		if cache_limit > 0: self.cache_parsed(url, return_type, parsed, params)
+		return parsed
+	
+	"""
+		Concurrent requests of one service with the same method, url, body and content headers share one fetch.
+		The service is part of the key as each service has its own session and cookie jar, see SessionPool.
+		The callers waiting on it receive the same body and response, see scrapecore.sessions.SingleFlight.
+		A waiter gives up with ScrapeCoreTimeout at the search deadline.
+	"""
+	def get_flight_key(self, url, params, headers):
+		relevant = [(k, headers[k]) for k in FLIGHT_HEADERS if k in headers]
+		return self.service + canonical_key(url, params) + json.dumps(relevant)
+	
+	def get_remaining(self):
+		if not self.deadline: return None
+		return max(self.deadline - time.time(), 0)
+	
+	def sleep(self, seconds):
+		if self.abort_event:
+			self.abort_event.wait(seconds)
 		else:
-			kodi.log(response)
-			kodi.log(response.headers)
-			response.raise_for_status()	
+			time.sleep(seconds)
+	
+	def is_throttled(self, response):
+		if response.status_code in THROTTLE_STATUS: return True
+		return response.status_code == 403 and CLOUDFLARE_TITLE in response.text
+	
+	def get_retry_delay(self, url, response, attempt):
+		retry_after = parse_retry_after(response.headers.get('Retry-After'))
+		if retry_after is None: return get_backoff(attempt)
+		limiter.pause(url, retry_after)
+		return retry_after
+	
+	"""
+		Throttled responses (429, 503 and the Cloudflare challenge page) are retried up to max_retries times.
+		The delay is the response's Retry-After, which also pauses the domain for every scraper, or else a jittered exponential backoff.
+		A retry is only made when the delay ends before the search deadline, otherwise the error is raised at once.
+		Any other 2xx returns its body, only a 200 is cached. Every other status raises requests.HTTPError,
+		so the loop only goes round again for a retry.
+		Counts of throttled and failed requests are kept per scraper and per service, see get_session_stats
+	"""
+	def fetch(self, url, params, headers, timeout, cache_limit=0):
+		attempt = 0
+		try:
+			while True:
+				response = self.send(url, params, headers, timeout)
+				response.encoding = 'utf-8'
+				self.last_response = response
+				if 200 <= response.status_code < 300:
+					html = response.text
+					break
+				if self.is_throttled(response):
+					self.increment('throttled_count')
+					limiter.count(self.service, 'throttled')
+					delay = self.get_retry_delay(url, response, attempt)
+					remaining = self.get_remaining()
+					if attempt < self.max_retries and (remaining is None or delay < remaining):
+						kodi.log('Throttled by %s (%s), retrying in %.1fs' % (url, response.status_code, delay))
+						attempt += 1
+						self.sleep(delay)
+						timeout = self.get_request_timeout(timeout)
+						continue
+				if response.status_code == 403 and CLOUDFLARE_TITLE in response.text:
+					kodi.log('protected by cloudflare')
+				else:
+					kodi.log(response)
+					kodi.log(response.headers)
+				raise requests.HTTPError('%s for url: %s' % (response.status_code, url), response=response)
+		except ScrapeCoreTimeout:
+			raise
+		except:
+			self.increment('failed_count')
+			limiter.count(self.service, 'failed')
+			raise
 		
-		if cache_limit > 0:
-			self.cache_response(cache_url, html, cache_limit)
-			
-		return self.process_response(html, return_type)
+		if cache_limit > 0 and response.status_code == requests.codes.ok:
+			self.cache_response(url, html, cache_limit, params, response.headers.get('Content-Type'), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+		return html, response
 				
 	def get_redirect(self, uri, append_base=True):
 		headers = {
@@ -353,7 +675,7 @@ class BaseScraper():
 			url = urljoin(base_url, uri)
 		else:
 			url = uri
-		response = self.session.head(url, timeout=self.timeout)
+		response = self.session.head(url, timeout=self.get_request_timeout())
 		if response.status_code == 302:
 			for k in response.headers:
 				if k.lower() == 'location' or k.lower() == 'content-location':
@@ -379,9 +701,7 @@ class BaseScraper():
 		url = self.build_url(uri, query, append_base)
 		if url is None: return ''
 
-		if timeout is None:
-			timeout = self.timeout
-		response = self.session.head(url, headers=headers, timeout=timeout, verify=False)
+		response = self.session.head(url, headers=headers, timeout=self.get_request_timeout(timeout), verify=False)
 		return response
 		
 """
@@ -453,23 +773,16 @@ class URLResolverScraper(BaseScraper):
 	
 class PremiumScraper(BaseScraper):
 	valid = kodi.get_setting('premiumize_enable', ADDON_ID) == 'true' and kodi.get_setting('premiumize_username', ADDON_ID) != '' or kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true' and kodi.get_setting('realdebrid_token', ADDON_ID) != ''
+	prefetch = True
 	
 	def get_domains(self):
-		if kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true':
-			self.realdebrid_hosts = realdebrid.get_hosts()
-		else:
-			self.realdebrid_hosts = []
-
-		if kodi.get_setting('premiumize_enable', ADDON_ID) == 'true':
-			self.premiumize_hosts = premiumize.get_hosts()
-		else:
-			self.premiumize_hosts = []
-			
-		self.domains = list(set(self.realdebrid_hosts + self.premiumize_hosts))
+		self.realdebrid_hosts = debrid.hosts.get('realdebrid')
+		self.premiumize_hosts = debrid.hosts.get('premiumize')
+		self.domains = self.realdebrid_hosts | self.premiumize_hosts
 		return self.domains
 	
 	def verify_result(self, result):
-		if result[0]['host'] not in self.domains: return
+		if not debrid.hosts.match(result[0]['host'], self.domains): return
 		media = self.make_media_object(result[0])
 		#if kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true':
 		#	cached = realdebrid.verify_link(media['raw_url'])
@@ -488,43 +801,42 @@ class PremiumScraper(BaseScraper):
 		
 		return (self.name, self.verified_results)	
 	
-	def resolve_url(self, raw_url):
-		resolved_url = ''
-		host = self.get_domain_from_url(raw_url)
-		if host not in self.get_domains(): return ''
-		from commoncore.dispatcher import WeightedDispatcher
-		dispatcher = WeightedDispatcher()
-		
-		@dispatcher.register(kodi.get_setting('premiumize_priority', ADDON_ID), [raw_url])
-		def pm_resolver(raw_url):
-			if host not in self.premiumize_hosts: return ''
-			try:
-				response = premiumize.get_download(raw_url)
-				return response['result']['location']
-			except:
-				return ''
-
-		@dispatcher.register(kodi.get_setting('realdebrid_priority', ADDON_ID), [raw_url])
-		def rd_resolver(raw_url):
-			if host not in self.realdebrid_hosts: return ''
-			try:
-				return realdebrid.resolve_url(raw_url)
-			except:
-				return ''
-		
-		kodi.open_busy_dialog()
+	def premiumize_resolver(self, raw_url, canceled):
 		try:
-			resolved_url = dispatcher.run()
+			response = premiumize.get_download(raw_url)
+			return response['result']['location'], None, None
 		except:
-			kodi.close_busy_dialog()
-		kodi.close_busy_dialog()
-		return resolved_url
+			return None
+
+	def realdebrid_resolver(self, raw_url, canceled):
+		try:
+			return realdebrid.resolve_url(raw_url), None, None
+		except:
+			return None
+
+	def get_resolvers(self, host):
+		resolvers = []
+		if debrid.hosts.match(host, self.premiumize_hosts):
+			resolvers.append((kodi.get_setting('premiumize_priority', ADDON_ID), 'premiumize', self.premiumize_resolver))
+		if debrid.hosts.match(host, self.realdebrid_hosts):
+			resolvers.append((kodi.get_setting('realdebrid_priority', ADDON_ID), 'realdebrid', self.realdebrid_resolver))
+		return resolvers
+	
+	def resolve_source(self, raw_url):
+		host = self.get_domain_from_url(raw_url)
+		if not debrid.hosts.match(host, self.get_domains()): return '', {}
+		resolver, result = debrid.resolve(self.get_resolvers(host), raw_url)
+		if not result: return '', {}
+		return result[0], {}
+	
+	def resolve_url(self, raw_url):
+		return self.resolve_playback(raw_url)
 
 """
 	PremiumizeScraper
 	This scraper will apply the PM flag to the results display
 	
-	resolve_url uses commoncore.premiumize.get_download to resolve the url
+	resolve_source uses commoncore.premiumize.get_download to resolve the url
 """
 
 class PremiumizeScraper(PremiumScraper):
@@ -539,31 +851,33 @@ class PremiumizeScraper(PremiumScraper):
 		self.make_media_object = make_media_object'''
 	
 	def verify_result(self, result):
-		if result[0]['host'] not in self.domains: return
+		if not debrid.hosts.match(result[0]['host'], self.domains): return
 		media = self.make_media_object(result[0])
 		self.verified_results.append(media)
 		
 	def get_domains(self):
-		self.domains = premiumize.get_hosts()
+		self.domains = debrid.hosts.get('premiumize')
+		return self.domains
 	
-	def resolve_url(self, raw_url):
+	def resolve_source(self, raw_url):
 		response = premiumize.get_download(raw_url)
 		try:
-			return response['result']['location']
+			return response['result']['location'], {}
 		except:
-			return ''
+			return '', {}
 
 """
 	RealDebridScraper
 	This scraper will apply the RD flag to the results display
 	
-	resolve_url uses commoncore.realdebrid.resolve_url to resolve the url
+	resolve_source uses commoncore.realdebrid.resolve_url to resolve the url
 """
 
 class RealDebridScraper(PremiumScraper):
 	valid = kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true' and kodi.get_setting('realdebrid_token', ADDON_ID) != ''
 	def get_domains(self):
-		self.domains = realdebrid.get_hosts()
+		self.domains = debrid.hosts.get('realdebrid')
+		return self.domains
 	
 	'''def __init__(self):
 		self._make_media_object = self.make_media_object
@@ -573,9 +887,9 @@ class RealDebridScraper(PremiumScraper):
 			return media
 		self.make_media_object = make_media_object'''
 	
-	def resolve_url(self, raw_url):
+	def resolve_source(self, raw_url):
 		resolved_url = realdebrid.resolve_url(raw_url)
-		return resolved_url
+		return resolved_url, {}
 
 
 """
@@ -591,7 +905,11 @@ class RealDebridScraper(PremiumScraper):
 class TorrentScraper(BaseScraper):
 	valid = (kodi.get_setting('premiumize_enable', ADDON_ID) == 'true' and kodi.get_setting('premiumize_username', ADDON_ID) != '') or kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true'
 	torrent = True
+	# Resolving a torrent adds a transfer to the user's debrid cloud, only do it for the source actually played
+	prefetch = False
 	return_cached = True
+	hash_broker = None
+	verified_hashes = {}
 	
 	def __init__(self):
 		self._make_media_object = self.make_media_object
@@ -622,121 +940,93 @@ class TorrentScraper(BaseScraper):
 			return self.get_hash_from_url(source)
 		
 	def check_hashes(self, hashes):
-		results = {'realdebrid': {}, "premiumize": {}}
-		if kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true':
-			results['realdebrid'] = realdebrid.check_hashes(hashes)
-			
-		if kodi.get_setting('premiumize_enable', ADDON_ID) == 'true':
-			results['premiumize'] = premiumize.check_hashes(hashes)
-		return results
+		if self.hash_broker is not None:
+			return self.hash_broker.check(hashes, self.get_hash_timeout())
+		return debrid.check_hashes(hashes)
+	
+	def get_hash_timeout(self):
+		if self.deadline is None: return debrid.HASH_CHECK_TIMEOUT
+		return max(min(self.deadline - time.time(), debrid.HASH_CHECK_TIMEOUT), 0)
 		
 	def get_torrent_services(self):
 		pass
 	
 	def verify_hash(self, hash):
-		if kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true':
-			try:
-				if self.verified_hashes['realdebrid'][hash]['rd'] != []: return True
-			except: pass
-		if kodi.get_setting('premiumize_enable', ADDON_ID) == 'true':
-			try:
-				if self.verified_hashes['premiumize']['hashes'][hash]['status'] == 'finished': return True
-			except: pass
+		if not hash: return False
+		hash = hash.lower()
+		for provider in debrid.enabled_providers():
+			if self.verified_hashes.get(provider, {}).get(hash, False): return True
 		return False
 		
 	def verify_results(self, processor, results):
-		hashes = [self.get_hash(r['raw_url']) for r in results]
-		self.verified_hashes = self.check_hashes(hashes)
-		for r in results:
-			hash = self.get_hash(r['raw_url'])
+		hashes = [(r, self.get_hash(r['raw_url'])) for r in results]
+		self.verified_hashes = self.check_hashes([h for r, h in hashes if h])
+		for r, hash in hashes:
 			if self.verify_hash(hash):
 				self.verify_result([r])
 		return (self.name, self.verified_results)
 	
-	def resolve_url(self, raw_url):
-		from commoncore.dispatcher import WeightedDispatcher
-		resolved_url = ''
-		hash = self.get_hash(raw_url)
-		kodi.set_property('Playback.Hash', hash)
-		
-		dispatcher = WeightedDispatcher()
-		@dispatcher.register(kodi.get_setting('premiumize_priority', ADDON_ID), [raw_url])
-		def premiumize_resolver(raw_url):
-			resolved_url = ''
-			if kodi.get_setting('premiumize_enable', ADDON_ID) != 'true': return resolved_url
-			attempt = 0
-			attempts = 5
-			try:
-				response = premiumize.create_transfer(raw_url)
-				id = response['id']	
-			except:
-				premiumize.clear_transfers()
-				response = premiumize.create_transfer(raw_url)
-				id = response['id']
-			try:	
-				while attempt < attempts:
-					folder_id = False
-					file_id = False
-					target_folder_id = False
-					kodi.log("Resolve Attempt %s" % attempt)
-					temp = premiumize.list_transfers()
-					for t in temp['transfers']:
-						if t['id'] == id and t['status'] == 'finished':
-							if 'target_folder_id' in t: target_folder_id = t['target_folder_id']
-							if 'folder_id' in t: folder_id = t['folder_id']
-							if 'file_id' in t: file_id = t['file_id']
-							break
-					if file_id:
-						response = premiumize.item_details(file_id)
-						resolved_url = response['stream_link']
-						kodi.set_property('Playback.Resolver', 'premiumize')
-						kodi.set_property('Playback.ID', file_id)
-						return resolved_url
-					if folder_id:
-						response = premiumize.list_folder(folder_id)
-						resolved_url = premiumize.get_folder_stream(response)
-						kodi.set_property('Playback.Resolver', 'premiumize')
-						kodi.set_property('Playback.ID', folder_id)
-						return resolved_url
-					if target_folder_id:
-						response = premiumize.list_folder(target_folder_id)
-						resolved_url = premiumize.get_folder_stream(response)
-						kodi.set_property('Playback.Resolver', 'premiumize')
-						kodi.set_property('Playback.ID', target_folder_id)
-						return resolved_url
-	
-					attempt += 1
-					kodi.sleep(150)
-			except:
-				pass
-			return resolved_url
-		
-		@dispatcher.register(kodi.get_setting('realdebrid_priority', ADDON_ID), [raw_url])
-		def realdebrid_resolver(raw_url):
-			resolved_url = ''
-			if kodi.get_setting('realdebrid_enable', ADDON_ID) != 'true': return resolved_url
-			response = realdebrid.add_torrent(raw_url)
-			try:
-				torrent_id = response['id']
-				info = realdebrid.get_torrent_info(torrent_id)
-				file_id = realdebrid.get_stream_file(info['files'])
-				if not file_id: return
-				realdebrid.select_torrent_files(torrent_id, file_id)
-				kodi.sleep(500)
-				info = realdebrid.get_torrent_info(torrent_id)
-				raw_url = info['links'][0]
-				kodi.set_property('Playback.Resolver', 'realdebrid')
-				kodi.set_property('Playback.ID', torrent_id)
-				resolved_url = realdebrid.resolve_url(raw_url)
-			except: pass
-			return resolved_url
-		
-		kodi.open_busy_dialog()
+	def premiumize_resolver(self, raw_url, canceled):
 		try:
-			resolved_url = dispatcher.run()
-		except Exception, e:
-			kodi.log(e)
-			kodi.close_busy_dialog()
-		kodi.close_busy_dialog()
+			response = premiumize.create_transfer(raw_url)
+			id = response['id']	
+		except:
+			premiumize.clear_transfers()
+			response = premiumize.create_transfer(raw_url)
+			id = response['id']
+		def progress(transfer):
+			try: percent = int(float(transfer['progress']) * 100)
+			except: percent = 0
+			kodi.log("Transfer %s: %s %s%%" % (id, transfer['status'], percent))
+		transfer = debrid.transfers.wait(id, canceled=canceled, progress=progress)
+		if transfer is None: return '', None, id
+		try:
+			if 'file_id' in transfer and transfer['file_id']:
+				response = premiumize.item_details(transfer['file_id'])
+				return response['stream_link'], transfer['file_id'], id
+			for key in ['folder_id', 'target_folder_id']:
+				if key in transfer and transfer[key]:
+					response = premiumize.list_folder(transfer[key])
+					return premiumize.get_folder_stream(response), transfer[key], id
+		except:
+			pass
+		return '', None, id
+	
+	def realdebrid_resolver(self, raw_url, canceled):
+		response = realdebrid.add_torrent(raw_url)
+		torrent_id = None
+		try:
+			torrent_id = response['id']
+			info = realdebrid.get_torrent_info(torrent_id)
+			file_id = realdebrid.get_stream_file(info['files'])
+			if not file_id: return '', None, torrent_id
+			realdebrid.select_torrent_files(torrent_id, file_id)
+			kodi.sleep(500)
+			info = realdebrid.get_torrent_info(torrent_id)
+			raw_url = info['links'][0]
+			return realdebrid.resolve_url(raw_url), torrent_id, torrent_id
+		except: pass
+		return '', None, torrent_id
+	
+	def get_resolvers(self):
+		resolvers = []
+		if kodi.get_setting('premiumize_enable', ADDON_ID) == 'true':
+			resolvers.append((kodi.get_setting('premiumize_priority', ADDON_ID), 'premiumize', self.premiumize_resolver))
+		if kodi.get_setting('realdebrid_enable', ADDON_ID) == 'true':
+			resolvers.append((kodi.get_setting('realdebrid_priority', ADDON_ID), 'realdebrid', self.realdebrid_resolver))
+		return resolvers
+	
+	def resolve_source(self, raw_url):
+		hash = self.get_hash(raw_url)
+		properties = {'Playback.Hash': hash}
+		def cleanup(resolver, result):
+			scrapecore.delete_torrent(resolver, hash, result[2])
 		
-		return resolved_url
+		resolver, result = debrid.resolve(self.get_resolvers(), raw_url, cleanup)
+		if not result: return '', properties
+		properties['Playback.Resolver'] = resolver
+		properties['Playback.ID'] = result[1]
+		return result[0], properties
+	
+	def resolve_url(self, raw_url):
+		return self.resolve_playback(raw_url)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+'''*
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*'''
+
+import sys
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+	The session pool
+	Each service gets its own requests.Session so cookies and keep-alive connections are not shared between scrapers.
+	Every session mounts an HTTPAdapter sized for the concurrency it will see:
+		pool_connections	the number of hosts kept alive per session
+		pool_maxsize		the number of connections kept alive per host
+	Connections are reused between requests to the same host. stats() reports how many were opened and reused.
+"""
+
+class SessionPool(object):
+	def __init__(self, pool_connections, pool_maxsize):
+		self.pool_connections = pool_connections
+		self.pool_maxsize = pool_maxsize
+		self._sessions = {}
+		self._lock = threading.Lock()
+
+	def create_session(self):
+		session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		return session
+
+	def get(self, key):
+		session = self._sessions.get(key)
+		if session is None:
+			with self._lock:
+				session = self._sessions.get(key)
+				if session is None:
+					session = self.create_session()
+					self._sessions[key] = session
+		return session
+
+	def close(self, key=None):
+		with self._lock:
+			keys = [key] if key is not None else self._sessions.keys()
+			for k in keys:
+				session = self._sessions.pop(k, None)
+				if session is not None: session.close()
+
+	def stats(self, key=None):
+		stats = {}
+		for k, session in self._sessions.items():
+			if key is not None and k != key: continue
+			opened = 0
+			requested = 0
+			adapters = set(session.adapters.values())
+			for adapter in adapters:
+				pools = adapter.poolmanager.pools
+				for pool_key in pools.keys():
+					pool = pools.get(pool_key)
+					if pool is None: continue
+					opened += pool.num_connections
+					requested += pool.num_requests
+			stats[k] = {"opened": opened, "reused": max(requested - opened, 0), "requests": requested}
+		return stats
+
+"""
+	SingleFlight
+	Coalesces identical requests that are in flight at the same time.
+	The first caller for a key runs the request, every caller arriving before it completes waits for it
+	and receives the same result, or the same exception.
+	A waiter given a timeout raises FlightTimeout if the request has not completed by then, the request itself carries on.
+	Counts are kept per group (the scraper service): requests actually sent and requests coalesced into another.
+"""
+
+class FlightTimeout(Exception):
+	pass
+
+class FlightCall(object):
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight(object):
+	def __init__(self):
+		self.counts = {}
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, func, group=None, timeout=None):
+		with self._lock:
+			counts = self.counts.setdefault(group, {"requests": 0, "coalesced": 0})
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = FlightCall()
+				counts['requests'] += 1
+			else:
+				counts['coalesced'] += 1
+		if not leader:
+			if not call.done.wait(timeout):
+				raise FlightTimeout('Timed out waiting for a shared request')
+			if call.error is not None:
+				raise call.error[0], call.error[1], call.error[2]
+			return call.result
+		try:
+			call.result = func()
+			return call.result
+		except:
+			call.error = sys.exc_info()
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+
+	def stats(self, group=None):
+		with self._lock:
+			if group is not None:
+				return dict(self.counts.get(group, {"requests": 0, "coalesced": 0}))
+			return dict([(k, dict(v)) for k, v in self.counts.items()])
@@ -11,4 +11,34 @@ CREATE TABLE IF NOT EXISTS "scrapers" (
 	"settings" TEXT,
 	"ts" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 	UNIQUE (service)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS "scraper_stats" (
+	"service" TEXT,
+	"searches" INTEGER DEFAULT 0,
+	"requests" INTEGER DEFAULT 0,
+	"errors" INTEGER DEFAULT 0,
+	"timeouts" INTEGER DEFAULT 0,
+	"results" INTEGER DEFAULT 0,
+	"duration" REAL DEFAULT 0,
+	"last_duration" REAL DEFAULT 0,
+	"ts" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY(service)
+);
+
+CREATE TABLE IF NOT EXISTS "scraper_quality_stats" (
+	"service" TEXT,
+	"quality" INTEGER,
+	"results" INTEGER DEFAULT 0,
+	PRIMARY KEY(service, quality)
+);
+
+CREATE TABLE IF NOT EXISTS "hash_cache" (
+	"provider" TEXT,
+	"hash" TEXT,
+	"cached" INTEGER DEFAULT 0,
+	"expires" REAL,
+	PRIMARY KEY(provider, hash)
+);
+
+CREATE INDEX IF NOT EXISTS "hash_cache_expires" ON "hash_cache" ("expires");
\ No newline at end of file